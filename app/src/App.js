@@ -1,5 +1,5 @@
 import React, { useEffect, useState } from 'react'
-import { Box, Typography } from '@mui/material'
+import { Box, Button, Typography } from '@mui/material'
 import Table from '@mui/material/Table';
 import TableBody from '@mui/material/TableBody';
 import TableCell from '@mui/material/TableCell';
@@ -23,15 +23,73 @@ import OpenLayerTiffRender from './OpenLayerTiffRender';
 import { fromLonLat, transformExtent } from 'ol/proj';
 import { getCenter } from 'ol/extent';
 
+// Rows already inserted by events are kept as they are, not added again
+const appendPage = (items, page) => {
+    const ids = new Set(items.map(item => item.id));
+    return [...items, ...page.filter(item => !ids.has(item.id))];
+};
+
+// List endpoints are paginated, next page cursor comes in `X-Next-Cursor` header
+const useCursorList = (url) => {
+    const [items, setItems] = useState([]);
+    const [nextCursor, setNextCursor] = useState(null);
+
+    const load = (cursor) => {
+        const separator = url.includes('?') ? '&' : '?';
+        fetch(cursor ? `${url}${separator}cursor=${encodeURIComponent(cursor)}` : url)
+        .then(response => {
+            setNextCursor(response.headers.get('X-Next-Cursor'));
+            return response.json();
+        })
+        .then(page => setItems(items => cursor ? appendPage(items, page) : page));
+    };
+
+    useEffect(() => load(null), [url]);
+
+    return [items, nextCursor ? () => load(nextCursor) : null, setItems, () => load(null)];
+};
+
+// Server-Sent Events from `/api/events`, `resync` means some events were missed
+const useEvents = (url, onEvent) => {
+    useEffect(() => {
+        const source = new EventSource(url);
+        ['task:created', 'task:updated', 'task:progress', 'object:created', 'object:updated', 'resync'].forEach(type =>
+            source.addEventListener(type, e => onEvent(type, JSON.parse(e.data)))
+        );
+        return () => source.close();
+    }, [url]);
+};
+
+const upsertById = (items, instance, prepend = false) => (
+    items.some(item => item.id == instance.id) ?
+    items.map(item => item.id == instance.id ? { ...item, ...instance } : item)
+    : prepend ? [instance, ...items] : [...items, instance]
+);
+
+const formatStatus = task => (
+    task.status == 'running' && task.progress != null ? `${task.status} ${Math.round(task.progress * 100)}%` : task.status
+);
+
+const LoadMore = ({ onClick }) => (
+    onClick ?
+    <Box display='flex' justifyContent='center' padding={2}>
+        <Button onClick={onClick}>Load more</Button>
+    </Box>
+    : null
+);
+
 const TasksList = () => {
     const navigate = useNavigate();
-    const [tasks, setTasks] = useState([]);
+    const [tasks, loadMoreTasks, setTasks, reloadTasks] = useCursorList('/api/tasks?fields=id,status,progress,start_time,stacktrace');
 
-    useEffect(() => {
-        fetch('/api/tasks')
-        .then(response => response.json())
-        .then(tasks => setTasks(tasks.map(t => ({...t, start_time: (new Date(t.start_time)).toLocaleString() }))));
-    }, []);
+    useEvents('/api/events', (type, event) => {
+        if (type == 'task:created' || type == 'task:updated')
+            setTasks(tasks => upsertById(tasks, event.instance, true));
+        if (type == 'task:progress')
+            setTasks(tasks => tasks.map(task => task.id == event.instance.id ? { ...task, ...event.instance } : task));
+        if (type == 'resync')
+            reloadTasks();
+    });
 
     return (
         <Box display='flex' justifyContent='center' alignItems='center' flexDirection='column'>
@@ -54,14 +112,15 @@ const TasksList = () => {
                             onClick={() => navigate(`/tasks/${task.id}`)}
                         >
                             <TableCell component="th" scope="row">{task.id}</TableCell>
-                            <TableCell align="right">{task.status}</TableCell>
-                            <TableCell align="right">{task.start_time }</TableCell>
+                            <TableCell align="right">{formatStatus(task)}</TableCell>
+                            <TableCell align="right">{(new Date(task.start_time)).toLocaleString()}</TableCell>
                             <TableCell align="right" sx={{ maxWidth: '100px' }}>{task.stacktrace}</TableCell>
                         </TableRow>
                     ))}
                     </TableBody>
                 </Table>
             </TableContainer>
+            <LoadMore onClick={loadMoreTasks} />
         </Box>
     );
 };
@@ -87,11 +146,11 @@ const JSONTreeTheme = {
     base0F: '#ab7967'
 };
 
-const JSONView = ({ object }) => {
+const JSONView = ({ object, url }) => {
     const [json, setJson] = useState({});
 
     useEffect(() => {
-        fetch(`/api/storage/${object.path}`)
+        fetch(url || `/api/storage/${object.path}`)
         .then(response => response.json())
         .then(json => setJson(json));
     }, []);
@@ -101,8 +160,8 @@ const JSONView = ({ object }) => {
 
 const ImageView = ({ object }) => {
     return (
-        <div style={{ cursor: 'pointer' }}>
-            <img width={'400px'} src={`/api/storage/${object.path}`} />
+        <div style={{ cursor: 'pointer' }} onClick={() => window.open(`/api/storage/${object.path}`)}>
+            <img width={'400px'} loading='lazy' src={`/api/objects/${object.id}/preview?size=400`} />
         </div>
     );
 }
@@ -122,6 +181,12 @@ const XYZView = ({ object }) => {
 }
 
 const GeoTiffView = ({ object }) => {
+    if (object.status == 'tiling')
+        return <span>Tiling...</span>
+
+    if (object.status == 'failed')
+        return <span>Tiling failed: {object.meta.error}</span>
+
     const extent = transformExtent(object.meta.extent, 'EPSG:4326', 'EPSG:3857');
     return (
         <div>
@@ -143,6 +208,9 @@ const ObjectView = ({ object }) => {
     if (object.type == 'json')
         return <JSONView object={object} />
 
+    if (object.type == 'detections')
+        return <JSONView object={object} url={`/api/objects/${object.id}/detections`} />
+
     if (object.type == 'image')
         return <ImageView object={object} />
 
@@ -158,17 +226,26 @@ const ObjectView = ({ object }) => {
 const ObjectsView = () => {
     const { taskId } = useParams();
     const [task, setTask] = useState(null);
-    const [objects, setObjects] = useState([]);
+    const [objects, loadMoreObjects, setObjects, reloadObjects] = useCursorList(`/api/objects?task_id=${taskId}`);
 
-    useEffect(() => {
+    const loadTask = () => {
         fetch(`/api/tasks/${taskId}`)
         .then(response => response.json())
         .then(task => setTask(task));
+    };
 
-        fetch(`/api/objects?task_id=${taskId}`)
-        .then(response => response.json())
-        .then(objects => setObjects(objects));
-    }, []);
+    useEffect(loadTask, []);
+
+    useEvents(`/api/events?task_id=${taskId}`, (type, event) => {
+        if (type == 'task:updated' || type == 'task:progress')
+            setTask(task => ({ ...task, ...event.instance }));
+        if (type == 'object:created' || type == 'object:updated')
+            setObjects(objects => upsertById(objects, event.instance));
+        if (type == 'resync') {
+            loadTask();
+            reloadObjects();
+        }
+    });
 
     return (
         <div style={{ paddingBottom: '8em' }}>
@@ -178,7 +255,7 @@ const ObjectsView = () => {
                         {
                             task ?
                             <>
-                                <div>{task.status}</div>
+                                <div>{formatStatus(task)}</div>
                                 <JSONTree data={task.inputs} theme={JSONTreeTheme} />
                                 <div>{task.stacktrace}</div>
                             </>
@@ -220,18 +297,13 @@ const ObjectsView = () => {
                     </Box>
                 ))
             }
+            <LoadMore onClick={loadMoreObjects} />
         </div>
     )
 };
 
 const ObjectsList = () => {
-    const [objects, setObjects] = useState([]);
-
-    useEffect(() => {
-        fetch(`/api/objects`)
-        .then(response => response.json())
-        .then(objects => setObjects(objects));
-    }, []);
+    const [objects, loadMoreObjects] = useCursorList('/api/objects?order=desc');
 
     return (
         <Box>
@@ -258,6 +330,7 @@ const ObjectsList = () => {
                     </Box>
                 ))
             }
+            <LoadMore onClick={loadMoreObjects} />
         </Box>
     );
 };
@@ -1,10 +1,662 @@
 import typing
+import asyncio
+import concurrent.futures
+import contextlib
+import hashlib
 import json
 import io
+import os
 import typing
+import uuid
 
 import aiohttp
-from PIL import Image
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _load_config() -> dict:
+    candidates = [
+        os.getenv('LOGSY_CONFIG'),
+        'logsy.config.json',
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logsy.config.json'),
+    ]
+    for path in candidates:
+        if path and os.path.exists(path):
+            with open(path) as file:
+                return json.load(file)
+    return { }
+
+
+config = {
+    'serverUrl': 'http://localhost:8000',
+    'maxConnections': 100,
+    'maxConnectionsPerHost': 0,
+    'keepaliveTimeout': 30,
+    'resumableUploadThreshold': 64 * 1024 * 1024,
+    'uploadConcurrency': 4,
+    'uploadRetries': 5,
+    'deduplicationThreshold': 64 * 1024,
+    'imageEncodeWorkers': 2,
+    # Offline spool, see `Spool`
+    'basePath': 'storage',
+    'spool': False,
+    'spoolDirectory': None,
+    'spoolBatchSize': 100,
+    'spoolDrainTimeout': 30,
+    'progressInterval': 0.5,
+    # `logsy-agent` task execution, see `logsy_executor`
+    'agentMaxConcurrency': 0,
+    'agentIsolation': 'process',
+    'agentTaskTimeout': None,
+    'agentMaxTasksPerWorker': 100,
+    'agentWarmWorkers': 2,
+    'agentPreload': [],
+    'agentId': None,
+    'agentUrl': None,
+    'agentHeartbeatInterval': 5,
+    **_load_config()
+}
+
+
+if orjson:
+    def dumps(value: typing.Any) -> bytes:
+        """JSON of uploaded payloads, orjson also takes numpy arrays, e.g. bboxes of detections"""
+        return orjson.dumps(value, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+
+    loads = orjson.loads
+else:
+    def dumps(value: typing.Any) -> bytes:
+        return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode()
+
+    loads = json.loads
+
+
+class Client:
+    """
+    Long-lived HTTP client shared by `Task`, `Group` and `Object`.
+
+    Owns a single `aiohttp.ClientSession` with a pooled keep-alive connector,
+    so log calls reuse connections instead of opening a new one each time.
+    Session is bound to the event loop it was created in and is recreated
+    transparently if used from another loop (e.g. consecutive `asyncio.run`),
+    the previous one is closed.
+    """
+
+    def __init__(
+        self,
+        server_url: str = None,
+        max_connections: int = None,
+        max_connections_per_host: int = None,
+        keepalive_timeout: float = None
+    ) -> None:
+        self.server_url = (server_url or config['serverUrl']).rstrip('/')
+        self.max_connections = max_connections if max_connections is not None else config['maxConnections']
+        self.max_connections_per_host = max_connections_per_host if max_connections_per_host is not None else config['maxConnectionsPerHost']
+        self.keepalive_timeout = keepalive_timeout if keepalive_timeout is not None else config['keepaliveTimeout']
+        self._session: aiohttp.ClientSession = None
+        self._loop: asyncio.AbstractEventLoop = None
+        # Closing sessions of previous loops, referenced until done
+        self._closing: set[asyncio.Task] = set()
+
+    def _close_stale(self):
+        """Close session of a previous event loop, on that loop while it runs, else from this one"""
+        session, loop = self._session, self._loop
+        if session is None or session.closed:
+            return
+        if loop.is_running() and not loop.is_closed():
+            asyncio.run_coroutine_threadsafe(session.close(), loop)
+        else:
+            # Connector of a closed loop only marks itself closed, its sockets went with the loop
+            closing = asyncio.get_running_loop().create_task(session.close())
+            self._closing.add(closing)
+            closing.add_done_callback(self._closing.discard)
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._loop is not loop:
+            self._close_stale()
+            connector = aiohttp.TCPConnector(
+                limit=self.max_connections,
+                limit_per_host=self.max_connections_per_host,
+                keepalive_timeout=self.keepalive_timeout
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                raise_for_status=True,
+                json_serialize=lambda value: dumps(value).decode()
+            )
+            self._loop = loop
+        return self._session
+
+    def request(self, method: str, path: str, **kwargs):
+        return self.session.request(method, f'{self.server_url}{path}', **kwargs)
+
+    def get(self, path: str, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path: str, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def patch(self, path: str, **kwargs):
+        return self.request('PATCH', path, **kwargs)
+
+    def put(self, path: str, **kwargs):
+        return self.request('PUT', path, **kwargs)
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        self._loop = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+
+client = Client()
+
+
+def configure(**kwargs) -> Client:
+    """Replace shared client, e.g. `configure(server_url=..., max_connections=16)`"""
+    global client
+    client = Client(**kwargs)
+    return client
+
+
+async def close():
+    global _image_encoder
+    await client.close()
+    if _image_encoder is not None:
+        _image_encoder.shutdown(wait=False)
+        _image_encoder = None
+
+
+def _read_chunk(path: str, offset: int, length: int) -> bytes:
+    with open(path, 'rb') as file:
+        file.seek(offset)
+        return file.read(length)
+
+
+def _missing_chunks(session: dict) -> list[int]:
+    chunk_size = session['chunk_size']
+    received = set()
+    for start, end in session['received']:
+        received.update(range(start // chunk_size, max(-(-end // chunk_size), start // chunk_size + 1)))
+    return [i for i in range(max(1, -(-session['size'] // chunk_size))) if i not in received]
+
+
+async def resume_upload(upload_id: str, path: str, concurrency: int = None, retries: int = None):
+    """
+    Send chunks of `path` the server has not received yet, several in parallel.
+    Failed chunks are retried with backoff by re-querying received ranges.
+    """
+    concurrency = concurrency or config['uploadConcurrency']
+    retries = retries if retries is not None else config['uploadRetries']
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def put_chunk(index: int, chunk_size: int, size: int):
+        async with semaphore:
+            offset = index * chunk_size
+            content = await asyncio.to_thread(_read_chunk, path, offset, min(chunk_size, size - offset))
+            async with client.request('PUT', f'/api/uploads/{upload_id}/chunks/{index}', data=content):
+                pass
+
+    # One more check of received ranges after the last attempt
+    for attempt in range(retries + 2):
+        async with client.get(f'/api/uploads/{upload_id}') as response:
+            session = await response.json()
+
+        missing = _missing_chunks(session)
+        if not missing:
+            return
+        if attempt > retries:
+            break
+
+        results = await asyncio.gather(
+            *(put_chunk(index, session['chunk_size'], session['size']) for index in missing),
+            return_exceptions=True
+        )
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if errors:
+            if attempt == retries:
+                raise errors[0]
+            print(f'Failed to upload {len(errors)} chunks, retrying', errors[0])
+            await asyncio.sleep(min(2 ** attempt, 30))
+
+    raise RuntimeError(f'Upload {upload_id} is still incomplete after {retries + 1} attempts')
+
+
+def _sha256_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        while chunk := file.read(1024 * 1024):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# (magic bytes, format used as file extension)
+IMAGE_SIGNATURES = [
+    (b'\xff\xd8\xff', 'jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+    (b'II*\x00', 'tiff'),
+    (b'MM\x00*', 'tiff'),
+    (b'BM', 'bmp'),
+]
+
+
+def sniff_image_format(header: bytes | memoryview) -> str:
+    """Image format from the first 16 bytes, nothing is decoded"""
+    header = bytes(header[:16])
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'webp'
+    for signature, format in IMAGE_SIGNATURES:
+        if header.startswith(signature):
+            return format
+    raise ValueError(f'Unsupported image format, header {header!r}')
+
+
+def _open_image(path: str) -> tuple[typing.BinaryIO, str]:
+    file = open(path, 'rb')
+    try:
+        format = sniff_image_format(file.read(16))
+        file.seek(0)
+        return file, format
+    except BaseException:
+        file.close()
+        raise
+
+
+def _sniff_file(file: typing.BinaryIO) -> str:
+    position = file.tell()
+    try:
+        return sniff_image_format(file.read(16))
+    finally:
+        file.seek(position)
+
+
+_image_encoder: concurrent.futures.ThreadPoolExecutor = None
+
+
+def _encode_image(image, format: str, quality: int) -> memoryview:
+    from PIL import Image
+
+    if isinstance(image, memoryview):
+        # Pixels `(height, width[, channels])` of unsigned bytes, wrapped without copying
+        height, width, *channels = image.shape
+        mode = { 1: 'L', 3: 'RGB', 4: 'RGBA' }[channels[0] if channels else 1]
+        image = Image.frombuffer(mode, (width, height), image, 'raw', mode, 0, 1)
+    elif not isinstance(image, Image.Image):
+        # numpy array or anything else with `__array_interface__`
+        image = Image.fromarray(image)
+
+    buffer = io.BytesIO()
+    image.save(buffer, format=format, **({ 'quality': quality } if format == 'jpeg' else { }))
+    return buffer.getbuffer()
+
+
+async def encode_image(image, format: str = 'png', quality: int = 90, in_thread: bool = True) -> memoryview:
+    """
+    Encode pixels to `format`. In a thread pool of `imageEncodeWorkers` by default,
+    Pillow releases GIL while encoding so event loop and other encodes keep going.
+    """
+    global _image_encoder
+    if not in_thread:
+        return _encode_image(image, format, quality)
+    if _image_encoder is None:
+        _image_encoder = concurrent.futures.ThreadPoolExecutor(config['imageEncodeWorkers'], thread_name_prefix='logsy-encode')
+    return await asyncio.get_running_loop().run_in_executor(_image_encoder, _encode_image, image, format, quality)
+
+
+async def find_stored_hash(path: str = None, content: bytes | memoryview | str = None) -> str | None:
+    """
+    Hash of the file or content if the server already stores these bytes, so the object
+    can be created by `hash` without sending them. Small payloads are not checked,
+    an extra round trip costs more than sending them.
+    """
+    if path is not None:
+        if os.path.getsize(path) < config['deduplicationThreshold']:
+            return None
+        hash = await asyncio.to_thread(_sha256_file, path)
+    else:
+        if isinstance(content, str):
+            content = content.encode()
+        if len(content) < config['deduplicationThreshold']:
+            return None
+        hash = await asyncio.to_thread(lambda: hashlib.sha256(content).hexdigest())
+
+    async with client.get(f'/api/blobs/{hash}', raise_for_status=False) as response:
+        if response.status == 404:
+            return None
+        response.raise_for_status()
+        return hash
+
+
+async def _iter_ndjson(path: str, params: dict) -> typing.AsyncIterator[dict]:
+    params = { key: value for key, value in params.items() if value is not None }
+    # Export can take long, only bound time between reads
+    timeout = aiohttp.ClientTimeout(total=None, sock_read=300)
+    async with client.get(path, params=params, timeout=timeout) as response:
+        buffer = b''
+        async for chunk in response.content.iter_any():
+            buffer += chunk
+            *lines, buffer = buffer.split(b'\n')
+            for line in lines:
+                if line:
+                    yield loads(line)
+        if buffer.strip():
+            yield loads(buffer)
+
+
+def export_tasks(status: str = None, start_time_from: str = None, start_time_to: str = None) -> typing.AsyncIterator[dict]:
+    """`async for task in logsy.export_tasks(start_time_from='2024-05-01')`"""
+    return _iter_ndjson('/api/export/tasks', {
+        'status': status,
+        'start_time_from': start_time_from,
+        'start_time_to': start_time_to,
+    })
+
+
+def export_objects(
+    task_id: int = None,
+    start_time_from: str = None,
+    start_time_to: str = None,
+    type: str = None,
+    inline: bool = False
+) -> typing.AsyncIterator[dict]:
+    """
+    Iterate objects streamed by the server, with `inline=True` JSON objects carry their `content`.
+    `async for object in logsy.export_objects(task_id=42, inline=True)`
+    """
+    return _iter_ndjson('/api/export/objects', {
+        'task_id': task_id,
+        'start_time_from': start_time_from,
+        'start_time_to': start_time_to,
+        'type': type,
+        'inline': 'true' if inline else None,
+    })
+
+
+async def upload_resumable(path: str, filename: str, concurrency: int = None, retries: int = None) -> str:
+    """Upload local file with chunked resumable protocol, returns upload id for `/complete`"""
+    async with client.post('/api/uploads', json={ 'filename': filename, 'size': os.path.getsize(path) }) as response:
+        session = await response.json()
+    await resume_upload(session['id'], path, concurrency, retries)
+    return session['id']
+
+
+class Spool:
+    """
+    Local on-disk spool of task writes, so `log_*` calls do not wait for the server.
+
+    Every task has an append-only log `task-{id}.log` of JSON records in the spool directory
+    (`spoolDirectory`, `{basePath}/spool` by default), payload bytes go to separate `.bin`
+    files. Background uploader drains each log strictly in order: consecutive objects are
+    sent in `/api/objects/bulk` batches of up to `spoolBatchSize`, status changes only after
+    every earlier object. Drained position is kept in `task-{id}.offset`, so after a crash
+    or restart draining continues where it stopped. Failed requests are retried with backoff
+    until the server is back, requests the server rejects (4xx) are skipped.
+
+    Processes share the spool directory, a log is drained only by the process holding the
+    exclusive lock of its `task-{id}.lock`, so objects are not uploaded twice.
+    """
+
+    def __init__(self, directory: str = None) -> None:
+        # Absolute, so processes and workers that change directory share one spool
+        self.directory = os.path.abspath(directory or config['spoolDirectory'] or os.path.join(config['basePath'], 'spool'))
+        self._loop: asyncio.AbstractEventLoop = None
+        self._wakeups: dict[int, asyncio.Event] = { }
+        self._idle: dict[int, asyncio.Event] = { }
+        self._drainers: dict[int, asyncio.Task] = { }
+        # Descriptors of held log locks (`None` without `fcntl`), kept across event loops of this process
+        self._locks: dict[int, int] = { }
+
+    def _log_path(self, task_id: int) -> str:
+        return os.path.join(self.directory, f'task-{task_id}.log')
+
+    def _lock_path(self, task_id: int) -> str:
+        return os.path.join(self.directory, f'task-{task_id}.lock')
+
+    def _try_lock(self, task_id: int) -> bool:
+        """Exclusive lock of the log without waiting, `False` while another process drains it"""
+        if task_id in self._locks:
+            return True
+        if fcntl is None:
+            self._locks[task_id] = None
+            return True
+        path = self._lock_path(task_id)
+        while True:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                return False
+            try:
+                # Previous holder removes the lock file with the drained log, lock a new one then
+                locked = os.fstat(fd).st_ino == os.stat(path).st_ino
+            except FileNotFoundError:
+                locked = False
+            if locked:
+                self._locks[task_id] = fd
+                return True
+            os.close(fd)
+
+    def _unlock(self, task_id: int):
+        fd = self._locks.pop(task_id, None)
+        if fd is not None:
+            os.remove(self._lock_path(task_id))
+            os.close(fd)
+
+    def _offset_path(self, task_id: int) -> str:
+        return os.path.join(self.directory, f'task-{task_id}.offset')
+
+    def _read_offset(self, task_id: int) -> int:
+        try:
+            with open(self._offset_path(task_id)) as file:
+                return int(file.read())
+        except FileNotFoundError:
+            return 0
+
+    def _write_offset(self, task_id: int, offset: int):
+        partial_path = f'{self._offset_path(task_id)}.part'
+        with open(partial_path, 'w') as file:
+            file.write(str(offset))
+        os.replace(partial_path, self._offset_path(task_id))
+
+    def _ensure_loop(self):
+        """
+        Drainers live in one event loop, logs left by previous loops or exited processes are
+        picked up, logs locked by a live process are left to it.
+        """
+        loop = asyncio.get_running_loop()
+        if self._loop is loop:
+            return
+        self._loop = loop
+        self._wakeups, self._idle, self._drainers = { }, { }, { }
+        os.makedirs(self.directory, exist_ok=True)
+        for name in os.listdir(self.directory):
+            if name.startswith('task-') and name.endswith('.log'):
+                task_id = int(name[len('task-'):-len('.log')])
+                if self._try_lock(task_id):
+                    self._wake(task_id)
+
+    def _wake(self, task_id: int):
+        if task_id not in self._drainers:
+            self._wakeups[task_id] = asyncio.Event()
+            self._idle[task_id] = asyncio.Event()
+            self._drainers[task_id] = self._loop.create_task(self._drain_forever(task_id))
+        self._idle[task_id].clear()
+        self._wakeups[task_id].set()
+
+    def _write_payload(self, content: bytes | memoryview) -> str:
+        name = f'{uuid.uuid4().hex}.bin'
+        with open(os.path.join(self.directory, name), 'wb') as file:
+            file.write(content)
+        return name
+
+    async def append(self, task_id: int, record: dict, payload: bytes | memoryview | str = None):
+        self._ensure_loop()
+        if payload is not None:
+            if isinstance(payload, str):
+                payload = payload.encode()
+            record = { **record, 'payload': await asyncio.to_thread(self._write_payload, payload) }
+        # One write of a whole line, readers only take lines that are complete
+        with open(self._log_path(task_id), 'ab') as file:
+            file.write(dumps(record) + b'\n')
+        self._wake(task_id)
+
+    def _read_pending(self, task_id: int) -> list[tuple[int, dict]]:
+        """`(end offset, record)` of records not drained yet"""
+        offset = self._read_offset(task_id)
+        records = []
+        if not os.path.exists(self._log_path(task_id)):
+            return records
+        with open(self._log_path(task_id), 'rb') as file:
+            file.seek(offset)
+            for line in file:
+                if not line.endswith(b'\n'):
+                    break
+                offset += len(line)
+                records.append((offset, loads(line)))
+        return records
+
+    def _remove_drained(self, task_id: int, records: list[dict]):
+        for record in records:
+            if 'payload' in record:
+                os.remove(os.path.join(self.directory, record['payload']))
+
+    async def _send_objects(self, task_id: int, records: list[dict]):
+        if len(records) == 1 and 'upload_path' in records[0] \
+                and os.path.getsize(records[0]['upload_path']) >= config['resumableUploadThreshold']:
+            record = records[0]
+            return await Task(id=task_id)._log_resumable(record['upload_path'], record['filename'], record['type'], record['algorithm_name'], record['meta'])
+
+        data = aiohttp.FormData()
+        specs = []
+        files_count = 0
+        with contextlib.ExitStack() as files:
+            for record in records:
+                spec = { 'type': record['type'], 'algorithm_name': record['algorithm_name'], 'meta': record['meta'] }
+                if 'content' in record:
+                    spec['content'] = record['content']
+                elif 'path' in record:
+                    spec['path'] = record['path']
+                else:
+                    source = record.get('upload_path') or os.path.join(self.directory, record['payload'])
+                    spec['file_index'] = files_count
+                    data.add_field('files', files.enter_context(await asyncio.to_thread(open, source, 'rb')), filename=record['filename'])
+                    files_count += 1
+                specs.append(spec)
+            data.add_field('objects', dumps(specs).decode())
+            async with client.post('/api/objects/bulk', params={ 'task_id': task_id }, data=data) as response:
+                pass
+
+    async def _send(self, task_id: int, records: list[dict]):
+        if records[0]['op'] == 'status':
+            async with client.patch(f'/api/tasks/{task_id}', json=records[0]['body']) as response:
+                pass
+        else:
+            await self._send_objects(task_id, records)
+
+    def _next_batch(self, pending: list[tuple[int, dict]]) -> list[tuple[int, dict]]:
+        """Leading objects up to `spoolBatchSize`, large uploads and status changes go alone"""
+        batch = []
+        for offset, record in pending:
+            alone = record['op'] == 'status' or 'upload_path' in record and \
+                os.path.exists(record['upload_path']) and os.path.getsize(record['upload_path']) >= config['resumableUploadThreshold']
+            if batch and (alone or len(batch) >= config['spoolBatchSize']):
+                break
+            batch.append((offset, record))
+            if alone:
+                break
+        return batch
+
+    async def _drain_forever(self, task_id: int):
+        attempt = 0
+        while True:
+            self._wakeups[task_id].clear()
+            pending = await asyncio.to_thread(self._read_pending, task_id)
+            if not pending:
+                self._idle[task_id].set()
+                await self._wakeups[task_id].wait()
+                continue
+            if task_id not in self._locks:
+                if not self._try_lock(task_id):
+                    # Another process drains the log this one appends to, it takes over if that one exits
+                    await asyncio.sleep(1)
+                # Read again under the lock, the previous holder may have drained more
+                continue
+
+            batch = await asyncio.to_thread(self._next_batch, pending)
+            records = [record for _, record in batch]
+            try:
+                await self._send(task_id, records)
+            except aiohttp.ClientResponseError as e:
+                if e.status >= 500 or e.status in (408, 429):
+                    attempt = await self._backoff(task_id, attempt, e)
+                    continue
+                print(f'Server rejected spooled {records[0]["op"]} of task {task_id}, skipping', e)
+            except FileNotFoundError as e:
+                print(f'File of spooled object of task {task_id} is gone, skipping', e)
+            except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+                attempt = await self._backoff(task_id, attempt, e)
+                continue
+
+            attempt = 0
+            await asyncio.to_thread(self._write_offset, task_id, batch[-1][0])
+            await asyncio.to_thread(self._remove_drained, task_id, records)
+            if records[-1]['op'] == 'status':
+                self._remove_log(task_id, batch[-1][0])
+
+    def _remove_log(self, task_id: int, offset: int):
+        """
+        Finished task with everything drained, later writes start a new log. Runs on the
+        event loop thread without awaits, so no `append` can slip in between check and removal.
+        """
+        if os.path.getsize(self._log_path(task_id)) == offset:
+            os.remove(self._log_path(task_id))
+            os.remove(self._offset_path(task_id))
+            self._unlock(task_id)
+
+    async def _backoff(self, task_id: int, attempt: int, error: Exception) -> int:
+        print(f'Spool of task {task_id} can not reach server, retrying', error)
+        await asyncio.sleep(min(2 ** attempt, 30))
+        return attempt + 1
+
+    async def drain(self, task_id: int = None, timeout: float = None) -> bool:
+        """
+        Wait until everything spooled for `task_id` (all tasks by default) reached the server,
+        `False` after `timeout` seconds. Records not drained by then stay in the spool and are
+        uploaded later by this event loop or by the next process using the spool.
+        """
+        self._ensure_loop()
+        idle = [self._idle[task_id]] if task_id in self._idle else [] if task_id is not None else list(self._idle.values())
+        try:
+            await asyncio.wait_for(asyncio.gather(*(event.wait() for event in idle)), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+
+spool = Spool()
+
+
+async def drain(timeout: float = None) -> bool:
+    return await spool.drain(timeout=timeout)
 
 
 class Group:
@@ -19,11 +671,10 @@ class Group:
 
     @staticmethod
     async def init(task_id: int, name: str):
-        async with aiohttp.ClientSession(raise_for_status=True) as session:
-            async with session.post('http://localhost:8000/api/groups', json={ 'task_id': task_id, 'name': name }) as response:
-                body = await response.json()
-                print('Created group', body)
-                return Group(body['id'], body['task_id'], body['name'])
+        async with client.post('/api/groups', json={ 'task_id': task_id, 'name': name }) as response:
+            body = await response.json()
+            print('Created group', body)
+            return Group(body['id'], body['task_id'], body['name'])
 
 
 class Object:
@@ -43,18 +694,17 @@ class Object:
         self.meta = meta
 
     @staticmethod
-    async def get(task_id: int):
-        async with aiohttp.ClientSession(raise_for_status=True) as session:
-            async with session.get(f'http://localhost:8000/api/tasks/{task_id}') as response:
-                body = await response.json()
-                return Object(
-                    body['id'],
-                    body['type'],
-                    body['path'],
-                    body['path_type'],
-                    body['algorithm_name'],
-                    body['meta']
-                )
+    async def get(object_id: int):
+        async with client.get(f'/api/objects/{object_id}') as response:
+            body = await response.json()
+            return Object(
+                body['id'],
+                body['type'],
+                body['path'],
+                body['path_type'],
+                body['algorithm_name'],
+                body['meta']
+            )
 
 
 class Task:
@@ -69,13 +719,121 @@ class Task:
     id: int
     inputs: dict
 
-    def __init__(self, id: int = None, inputs: dict = None) -> None:
+    def __init__(self, id: int = None, inputs: dict = None, buffer_size: int = 0, flush_interval: float = 1.0, spool: bool = None) -> None:
+        """
+        With `buffer_size > 0` inline `log_json` calls are collected and sent in one
+        `/api/objects/bulk` request when buffer is full or `flush_interval` seconds passed.
+
+        With `spool=True` (`spool` in config by default) `log_*`, `set_result` and `set_exception`
+        only append to the local `Spool` and return, the server gets them in background.
+        """
         self.id = id
         self.inputs = inputs if inputs else { }
+        self.spool = spool if spool is not None else config['spool']
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self._buffer: list[tuple[dict, typing.Any]] = []
+        self._flush_timer: asyncio.Task = None
+        self._flush_lock = asyncio.Lock()
+        # Latest progress not sent yet, sender sends at most one update per `progressInterval`
+        self._progress: float = None
+        self._progress_sender: asyncio.Task = None
+        self._progress_flush = asyncio.Event()
 
     async def create_group(self, name: str):
         return await Group.init(self.id, name)
 
+    def export_objects(self, type: str = None, inline: bool = False) -> typing.AsyncIterator[dict]:
+        return export_objects(task_id=self.id, type=type, inline=inline)
+
+    async def _spool_object(
+        self,
+        type: str,
+        filename: str,
+        algorithm_name: str,
+        meta: dict,
+        object = None,
+        path: str = None,
+        upload: bool = True,
+        file_content = None,
+        file: typing.BinaryIO = None
+    ):
+        record = { 'op': 'object', 'type': type, 'filename': filename, 'algorithm_name': algorithm_name, 'meta': meta }
+        if object is not None:
+            record['content'] = object
+        elif path and not upload:
+            record['path'] = path
+        elif path:
+            # Not copied, file must stay in place until drained
+            record['upload_path'] = os.path.abspath(path)
+        elif file_content is not None:
+            return await spool.append(self.id, record, file_content)
+        elif file:
+            return await spool.append(self.id, record, await asyncio.to_thread(file.read))
+        await spool.append(self.id, record)
+
+    async def _spool_status(self, body: dict):
+        await spool.append(self.id, { 'op': 'status', 'body': body })
+        if not await spool.drain(self.id, config['spoolDrainTimeout']):
+            print(f'Task {self.id} is not drained yet, spool keeps it for later')
+
+    async def _buffer_object(self, spec: dict, file_content = None):
+        self._buffer.append((spec, file_content))
+        if len(self._buffer) >= self.buffer_size:
+            await self.flush()
+        elif self._flush_timer is None:
+            self._flush_timer = asyncio.get_running_loop().create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        self._flush_timer = None
+        try:
+            await self.flush()
+        except Exception as e:
+            print('Failed to flush buffered objects', e)
+
+    async def _log_resumable(self, path: str, filename: str, type: str, algorithm_name: str, meta: dict):
+        upload_id = await upload_resumable(path, filename)
+
+        params = { 'task_id': self.id } if self.id else { }
+        data = aiohttp.FormData()
+        data.add_field('algorithm_name', algorithm_name)
+        data.add_field('type', type)
+        data.add_field('meta', dumps(meta).decode())
+        async with client.post(f'/api/uploads/{upload_id}/complete', params=params, data=data) as response:
+            print(await response.json())
+
+    async def flush(self):
+        """Send buffered objects, no-op if nothing buffered"""
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+
+        async with self._flush_lock:
+            if not self._buffer:
+                return
+            buffer, self._buffer = self._buffer, []
+
+            params = { 'task_id': self.id } if self.id else { }
+            data = aiohttp.FormData()
+            specs = []
+            files_count = 0
+            for spec, file_content in buffer:
+                if file_content is not None:
+                    spec = { **spec, 'file_index': files_count }
+                    data.add_field('files', file_content, filename='file.json')
+                    files_count += 1
+                specs.append(spec)
+            data.add_field('objects', dumps(specs).decode())
+
+            try:
+                async with client.post('/api/objects/bulk', params=params, data=data) as response:
+                    print(await response.json())
+            except BaseException:
+                # Keep objects for the next flush attempt
+                self._buffer[:0] = buffer
+                raise
+
 
     async def log_json(
         self,
@@ -87,60 +845,144 @@ class Task:
         meta: dict = {},
         upload: bool = True
     ):
+        if self.spool:
+            return await self._spool_object('json', 'file.json', algorithm_name, meta, object, path, upload, file_content, file)
+
+        if self.buffer_size and (object or file_content or (path and not upload)):
+            spec = { 'type': 'json', 'algorithm_name': algorithm_name, 'meta': meta }
+            if object:
+                spec['content'] = object
+            elif file_content:
+                return await self._buffer_object(spec, file_content)
+            else:
+                spec['path'] = path
+            return await self._buffer_object(spec)
+
+        # Keep objects order
+        await self.flush()
+
         params = { 'task_id': self.id } if self.id else { }
         data = aiohttp.FormData()
         data.add_field('algorithm_name', algorithm_name)
         data.add_field('type', 'json')
-        data.add_field('meta', json.dumps(meta))
+        data.add_field('meta', dumps(meta).decode())
 
-        if object:
-            data.add_field('file', json.dumps(object), filename='file.json')
-        elif path:
-            if upload:
-                data.add_field('file', open(path, 'rb'), filename='file.json')
-            else:
-                data.add_field('path', path)
-        elif file_content:
-            data.add_field('file', file_content, filename='file.json')
-        elif file:
-            data.add_field('file', file, filename='file.json')
+        with contextlib.ExitStack() as files:
+            if object:
+                data.add_field('file', dumps(object), filename='file.json')
+            elif path:
+                if upload:
+                    if hash := await find_stored_hash(path=path):
+                        data.add_field('hash', hash)
+                    else:
+                        file = files.enter_context(await asyncio.to_thread(open, path, 'rb'))
+                        data.add_field('file', file, filename='file.json')
+                else:
+                    data.add_field('path', path)
+            elif file_content:
+                if hash := await find_stored_hash(content=file_content):
+                    data.add_field('hash', hash)
+                else:
+                    data.add_field('file', file_content, filename='file.json')
+            elif file:
+                data.add_field('file', file, filename='file.json')
 
-        async with aiohttp.ClientSession(raise_for_status=True) as session:
-            async with session.post('http://localhost:8000/api/objects', params=params, data=data) as response:
+            async with client.post('/api/objects', params=params, data=data) as response:
                 print(await response.json())
 
 
+    async def log_detections(self, detections: list[dict], algorithm_name: str = None, meta: dict = {}):
+        """
+        `[{ category_name, confidence, bbox: { x, y, width, height } | [x, y, width, height] }]`, numpy arrays
+        are fine with orjson. Server stores them in columnar form, queried with `GET /api/detections`.
+        """
+        if self.spool:
+            return await self._spool_object('detections', 'detections.json', algorithm_name, meta, detections)
+
+        spec = { 'type': 'detections', 'algorithm_name': algorithm_name, 'meta': meta, 'content': detections }
+        if self.buffer_size:
+            return await self._buffer_object(spec)
+
+        # Keep objects order
+        await self.flush()
+
+        params = { 'task_id': self.id } if self.id else { }
+        data = aiohttp.FormData()
+        data.add_field('algorithm_name', algorithm_name)
+        data.add_field('type', 'detections')
+        data.add_field('meta', dumps(meta).decode())
+        data.add_field('file', dumps(detections), filename='detections.json')
+        async with client.post('/api/objects', params=params, data=data) as response:
+            print(await response.json())
+
+
     async def log_image(
         self,
         path: str = None,
-        file_content: str = None,
+        file_content: bytes | memoryview = None,
         file: typing.BinaryIO = None,
         algorithm_name: str = None,
         meta: dict = {},
-        upload: bool = True
+        upload: bool = True,
+        image = None,
+        image_format: str = 'png',
+        quality: int = 90,
+        encode_in_thread: bool = True
     ):
+        """
+        Image from `path` (streamed from disk), encoded bytes in `file_content`, binary `file`
+        or pixels in `image` (numpy array, PIL image or `(height, width[, channels])` memoryview)
+        encoded to `image_format` off the event loop unless `encode_in_thread=False`.
+        Format of encoded images is detected from their magic bytes.
+        """
+        await self.flush()
+
+        if image is not None:
+            file_content = await encode_image(image, image_format, quality, encode_in_thread)
+
+        if self.spool:
+            if path and upload:
+                opened, extension = await asyncio.to_thread(_open_image, path)
+                opened.close()
+            elif file_content is not None:
+                extension = sniff_image_format(memoryview(file_content).cast('B'))
+            elif file:
+                extension = await asyncio.to_thread(_sniff_file, file)
+            else:
+                extension = None
+            return await self._spool_object('image', f'file.{extension}', algorithm_name, meta, None, path, upload, file_content, file)
+
         params = { 'task_id': self.id } if self.id else { }
         data = aiohttp.FormData()
         data.add_field('algorithm_name', algorithm_name)
         data.add_field('type', 'image')
-        data.add_field('meta', json.dumps(meta))
+        data.add_field('meta', dumps(meta).decode())
 
-        if path:
-            if upload:
-                extension = Image.open('image.jpg').format.lower()
-                data.add_field('file', open(path, 'rb'), filename=f'file.{extension}')
-            else:
-                data.add_field('path', path)
-        elif file_content:
-            extension = Image.open(io.BytesIO(file_content)).format.lower()
-            data.add_field('file', file_content, filename=f'file.{extension}')
-        elif file:
-            extension = Image.open(file).format.lower()
-            file.seek(0)
-            data.add_field('file', file, filename=f'file.{extension}')
+        with contextlib.ExitStack() as files:
+            if path:
+                if upload:
+                    if hash := await find_stored_hash(path=path):
+                        data.add_field('hash', hash)
+                    else:
+                        # aiohttp streams the file in chunks read off the event loop
+                        opened, extension = await asyncio.to_thread(_open_image, path)
+                        files.enter_context(opened)
+                        if os.fstat(opened.fileno()).st_size >= config['resumableUploadThreshold']:
+                            return await self._log_resumable(path, f'file.{extension}', 'image', algorithm_name, meta)
+                        data.add_field('file', opened, filename=f'file.{extension}')
+                else:
+                    data.add_field('path', path)
+            elif file_content is not None:
+                if hash := await find_stored_hash(content=file_content):
+                    data.add_field('hash', hash)
+                else:
+                    extension = sniff_image_format(memoryview(file_content).cast('B'))
+                    data.add_field('file', file_content, filename=f'file.{extension}')
+            elif file:
+                extension = await asyncio.to_thread(_sniff_file, file)
+                data.add_field('file', file, filename=f'file.{extension}')
 
-        async with aiohttp.ClientSession(raise_for_status=True) as session:
-            async with session.post('http://localhost:8000/api/objects', params=params, data=data) as response:
+            async with client.post('/api/objects', params=params, data=data) as response:
                 print(await response.json())
 
     # async def log_xyz(
@@ -155,7 +997,7 @@ class Task:
     #     data.add_field('type', 'xyz')
     #     data.add_field('path', path)
     #     if meta:
-    #         data.add_field('meta', json.dumps(meta))
+    #         data.add_field('meta', dumps(meta).decode())
 
     #     async with aiohttp.ClientSession(raise_for_status=False) as session:
     #         async with session.post('http://localhost:8000/api/objects', params=params, data=data) as response:
@@ -171,58 +1013,98 @@ class Task:
         meta: dict = {},
         upload: bool = True
     ):
+        if self.spool:
+            return await self._spool_object('geotiff', 'file.tiff', algorithm_name, meta, None, path, upload, file_content, file)
+
+        await self.flush()
+
         params = { 'task_id': self.id } if self.id else { }
         data = aiohttp.FormData()
         data.add_field('algorithm_name', algorithm_name)
         data.add_field('type', 'geotiff')
-        data.add_field('meta', json.dumps(meta))
+        data.add_field('meta', dumps(meta).decode())
 
-        if path:
-            if upload:
-                data.add_field('file', open(path, 'rb'), filename='file.tiff')
-            else:
-                data.add_field('path', path)
-        elif file_content:
-            data.add_field('file', file_content, filename='file.tiff')
-        elif file:
-            data.add_field('file', file, filename='file.tiff')
+        with contextlib.ExitStack() as files:
+            if path:
+                if upload:
+                    if hash := await find_stored_hash(path=path):
+                        data.add_field('hash', hash)
+                    elif os.path.getsize(path) >= config['resumableUploadThreshold']:
+                        return await self._log_resumable(path, 'file.tiff', 'geotiff', algorithm_name, meta)
+                    else:
+                        file = files.enter_context(await asyncio.to_thread(open, path, 'rb'))
+                        data.add_field('file', file, filename='file.tiff')
+                else:
+                    data.add_field('path', path)
+            elif file_content:
+                if hash := await find_stored_hash(content=file_content):
+                    data.add_field('hash', hash)
+                else:
+                    data.add_field('file', file_content, filename='file.tiff')
+            elif file:
+                data.add_field('file', file, filename='file.tiff')
 
-        async with aiohttp.ClientSession(raise_for_status=True) as session:
-            async with session.post('http://localhost:8000/api/objects', params=params, data=data) as response:
+            async with client.post('/api/objects', params=params, data=data) as response:
                 print(await response.json())
 
     @staticmethod
-    async def init(inputs: dict = {}):
-        async with aiohttp.ClientSession(raise_for_status=True) as session:
-            async with session.post('http://localhost:8000/api/tasks', json={ 'inputs': inputs }) as response:
-                body = await response.json()
-                print('Created task', body)
-                return Task(id=body['id'])
+    async def init(inputs: dict = {}, buffer_size: int = 0, flush_interval: float = 1.0, spool: bool = None):
+        async with client.post('/api/tasks', json={ 'inputs': inputs }) as response:
+            body = await response.json()
+            print('Created task', body)
+            return Task(id=body['id'], buffer_size=buffer_size, flush_interval=flush_interval, spool=spool)
 
     @staticmethod
     async def get(task_id: int):
-        async with aiohttp.ClientSession(raise_for_status=True) as session:
-            async with session.get(f'http://localhost:8000/api/tasks/{task_id}') as response:
-                body = await response.json()
-                return Task(id=body['id'])
+        async with client.get(f'/api/tasks/{task_id}') as response:
+            body = await response.json()
+            return Task(id=body['id'])
 
     async def set_result(self):
-        async with aiohttp.ClientSession(raise_for_status=True) as session:
-            async with session.patch(f'http://localhost:8000/api/tasks/{self.id}', json={ 'status': 'completed' }) as response:
-                pass
+        await self.flush()
+        await self.flush_progress()
+        if self.spool:
+            return await self._spool_status({ 'status': 'completed' })
+        async with client.patch(f'/api/tasks/{self.id}', json={ 'status': 'completed' }) as response:
+            pass
 
     async def set_exception(self, stacktrace=None):
+        await self.flush()
+        await self.flush_progress()
         json={ 'status': 'aborted', 'stacktrace': stacktrace }
-        async with aiohttp.ClientSession(raise_for_status=True) as session:
-            async with session.patch(f'http://localhost:8000/api/tasks/{self.id}', json=json) as response:
-                pass
+        if self.spool:
+            return await self._spool_status(json)
+        async with client.patch(f'/api/tasks/{self.id}', json=json) as response:
+            pass
 
-    async def set_progress(self, progress: float): pass
+    async def set_progress(self, progress: float):
+        """
+        Progress in `[0, 1]`. Cheap to call in a tight loop: calls only replace the
+        pending value, which is sent in background at most every `progressInterval` seconds.
+        """
+        self._progress = progress
+        if self._progress_sender is None or self._progress_sender.done():
+            self._progress_sender = asyncio.get_running_loop().create_task(self._send_progress())
 
+    async def _send_progress(self):
+        while self._progress is not None:
+            progress, self._progress = self._progress, None
+            try:
+                async with client.put(f'/api/tasks/{self.id}/progress', json={ 'progress': progress }) as response:
+                    pass
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                # Progress is best effort, it never fails the task
+                print('Failed to send progress', e)
+            try:
+                await asyncio.wait_for(self._progress_flush.wait(), config['progressInterval'])
+            except asyncio.TimeoutError:
+                pass
+
+    async def flush_progress(self):
+        """Send pending progress now and wait for it"""
+        if self._progress_sender is not None:
+            self._progress_flush.set()
+            await self._progress_sender
+            self._progress_flush.clear()
+            self._progress_sender = None
 
-class Object:
-    @staticmethod
-    async def init():
-        async with aiohttp.ClientSession(raise_for_status=True) as session:
-            async with session.post('http://localhost:8000/api/objects') as response:
-                body = await response.json()
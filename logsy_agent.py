@@ -1,44 +1,113 @@
-import importlib
+from contextlib import asynccontextmanager
+import argparse
 import asyncio
 import traceback
+import uuid
 
+import aiohttp
 import fastapi
 import pydantic
 
-from logsy import Task
+import logsy
+from logsy import Task, config
+from logsy_executor import TaskExecutor, import_entry_point
+
+
+executor = TaskExecutor()
+agent_id = config['agentId'] or uuid.uuid4().hex
+# Address the server dispatches tasks to, `serve` defaults it to localhost and its port
+agent_url = config['agentUrl']
+
+
+async def heartbeat_forever():
+    """Registers agent on the server and reports capacity and load"""
+    while True:
+        metrics = executor.metrics()
+        try:
+            async with logsy.client.post('/api/agents/heartbeat', json={
+                'id': agent_id,
+                'url': agent_url,
+                'capacity': metrics['max_concurrency'],
+                'running': metrics['running'],
+                'queued': metrics['queued'],
+            }) as response:
+                pass
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print('Heartbeat failed', e)
+        except Exception:
+            # Anything else must not stop heartbeats, or the server requeues tasks running here
+            print('Heartbeat failed')
+            traceback.print_exc()
+        await asyncio.sleep(config['agentHeartbeatInterval'])
+
+
+@asynccontextmanager
+async def lifespan(app: fastapi.FastAPI):
+    await executor.init()
+    heartbeat = asyncio.create_task(heartbeat_forever()) if agent_url else None
+    yield
+    if heartbeat:
+        heartbeat.cancel()
+        await asyncio.gather(heartbeat, return_exceptions=True)
+    await executor.close()
+    await logsy.close()
+
+
+app = fastapi.FastAPI(lifespan=lifespan)
 
 
-app = fastapi.FastAPI()
-
+class RunTaskRequest(pydantic.BaseModel):
+    task_id: int
+    entry_point: str
+    # Higher runs first
+    priority: int = 0
+    # Seconds, `agentTaskTimeout` by default
+    timeout: float = None
+    # `SourceCode.hash`, entry point is reimported in warm workers when it changes
+    source_hash: str = None
 
-async def perform_run_task(task_id: int, entry_point: str):
-    module = importlib.import_module(f'.{entry_point.split(".")[0]}', 'storage')
 
+@app.post('/api/tasks/run')
+async def run_task(body: RunTaskRequest):
+    """Queue task for a worker process, response has `position` in the queue"""
     try:
-        task = Task(id=task_id)
-        await module.main(task)
-    except BaseException:
-        stacktrace = traceback.format_exc()
-        print(stacktrace)
-        await task.set_exception(stacktrace)
+        job = await executor.submit(body.task_id, body.entry_point, body.priority, body.timeout, body.source_hash)
+    except ValueError as e:
+        raise fastapi.HTTPException(status_code=409, detail=str(e))
+    return executor.describe(job)
 
 
-class RunTaskRequest(pydantic.BaseModel):
-    task_id: int
-    entry_point: str
+@app.get('/api/tasks/run/{task_id}')
+async def get_run(task_id: int):
+    job = executor.get(task_id)
+    if job is None:
+        raise fastapi.HTTPException(status_code=404)
+    return executor.describe(job)
 
 
-@app.post('/api/tasks/run')
-async def run_task(body: RunTaskRequest, background_tasks: fastapi.BackgroundTasks):
-    print(background_tasks)
-    background_tasks.add_task(perform_run_task, body.task_id, body.entry_point)
+@app.delete('/api/tasks/run/{task_id}')
+async def cancel_run(task_id: int):
+    job = await executor.cancel(task_id)
+    if job is None:
+        raise fastapi.HTTPException(status_code=404)
+    return executor.describe(job)
+
+
+@app.get('/api/metrics')
+async def get_metrics():
+    return executor.metrics()
+
+
+def serve(host: str, port: int):
+    import uvicorn
 
+    global agent_url
+    agent_url = agent_url or f'http://localhost:{port}'
+    uvicorn.run(app, host=host, port=port)
 
-async def main():
-    # module = importlib.import_module('task')
 
-    entrypoint = 'src_efc4c716.py'
-    module = importlib.import_module(f'.{entrypoint.split(".")[0]}', 'storage')
+async def run_local(entrypoint: str):
+    module = import_entry_point(entrypoint)
 
     try:
         task = await Task.init()
@@ -47,7 +116,22 @@ async def main():
         stacktrace = traceback.format_exc()
         print(stacktrace)
         await task.set_exception(stacktrace)
+    finally:
+        await logsy.close()
 
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    # Several local agents: `python logsy_agent.py serve --port 8001`, `... --port 8002`
+    parser = argparse.ArgumentParser(description='logsy-agent')
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve_parser = commands.add_parser('serve', help='Run agent API and heartbeat to the server')
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8001)
+    run_parser = commands.add_parser('run', help='Run entry point from `storage` in this process as a new task')
+    run_parser.add_argument('entrypoint')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        serve(args.host, args.port)
+    else:
+        asyncio.run(run_local(args.entrypoint))
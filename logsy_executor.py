@@ -0,0 +1,478 @@
+"""
+Execution engine of `logsy-agent`.
+
+User code (`module.main(task)`) runs in worker processes, so CPU-bound algorithms
+do not block the agent or each other. At most `agentMaxConcurrency` tasks run at
+once, the rest wait in a priority queue (higher `priority` first, FIFO within
+a priority). Running tasks can be cancelled or time out, their worker process is
+terminated and the task is aborted on the server.
+
+Isolation (`agentIsolation`):
+- `process` - fresh worker process per task
+- `pool` - workers are reused for up to `agentMaxTasksPerWorker` tasks
+
+Workers are pre-forked, `agentWarmWorkers` of them wait idle with entry points of
+`agentPreload` and recently run ones already imported. A worker imports an entry point
+once per source content hash (`source_hash` of the run request, sha256 of the file
+otherwise), so module-level state like loaded model weights survives between tasks
+of a `pool` worker and changed source is reloaded. Tasks go to idle workers that have
+their entry point loaded first.
+
+Each finished job has resource usage of its run: wall time, user/system CPU time,
+peak RSS of the worker process and startup latency (worker spawn + import).
+"""
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import datetime
+import enum
+import hashlib
+import heapq
+import importlib
+import itertools
+import multiprocessing
+import multiprocessing.connection
+import os
+import resource
+import sys
+import time
+import traceback
+import types
+
+import logsy
+from logsy import Task, config
+
+
+class JobState(enum.Enum):
+    queued      = 'queued'
+    running     = 'running'
+    completed   = 'completed'
+    failed      = 'failed'
+    cancelled   = 'cancelled'
+    timed_out   = 'timed_out'
+
+
+# Recently run entry points preloaded into new workers
+RECENT_ENTRY_POINTS = 4
+
+
+def import_entry_point(entry_point: str):
+    return importlib.import_module(f'.{entry_point.split(".")[0]}', 'storage')
+
+
+def source_hash(entry_point: str) -> str:
+    with open(os.path.join('storage', f'{entry_point.split(".")[0]}.py'), 'rb') as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+
+# Worker process side, entry point -> (source hash, module)
+_modules: dict[str, tuple[str, types.ModuleType]] = { }
+
+
+def load_entry_point(entry_point: str, hash: str = None) -> tuple[types.ModuleType, str, float]:
+    """`(module, source hash, import seconds)`, import time is `0` when the module is cached"""
+    hash = hash or source_hash(entry_point)
+    cached = _modules.get(entry_point)
+    if cached and cached[0] == hash:
+        return cached[1], hash, 0.0
+
+    started = time.perf_counter()
+    importlib.invalidate_caches()
+    name = f'storage.{entry_point.split(".")[0]}'
+    # Source changed, `reload` executes it again with fresh module-level state
+    module = importlib.reload(sys.modules[name]) if name in sys.modules else import_entry_point(entry_point)
+    _modules[entry_point] = (hash, module)
+    return module, hash, time.perf_counter() - started
+
+
+def _loaded() -> dict[str, str]:
+    return { entry_point: hash for entry_point, (hash, _) in _modules.items() }
+
+
+async def _run_main(task_id: int, entry_point: str, hash: str | None, startup: dict) -> str | None:
+    """Returns stacktrace if import or `main` failed, task is already aborted then"""
+    task = Task(id=task_id)
+    try:
+        module, _, startup['import_time'] = load_entry_point(entry_point, hash)
+        await module.main(task)
+    except BaseException:
+        stacktrace = traceback.format_exc()
+        print(stacktrace)
+        await task.set_exception(stacktrace)
+        return stacktrace
+    finally:
+        await logsy.close()
+
+
+def _run_job(task_id: int, entry_point: str, hash: str | None) -> dict:
+    started = time.perf_counter()
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    startup = { 'import_time': 0.0 }
+    error = asyncio.run(_run_main(task_id, entry_point, hash, startup))
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    return {
+        'error': error,
+        'loaded': _loaded(),
+        'usage': {
+            'wall_time': time.perf_counter() - started,
+            'cpu_user': after.ru_utime - before.ru_utime,
+            'cpu_system': after.ru_stime - before.ru_stime,
+            # Peak of the worker process so far, kilobytes on Linux
+            'max_rss': after.ru_maxrss,
+            'import_time': startup['import_time'],
+        }
+    }
+
+
+def _preload(entry_points: dict[str, str | None]) -> dict:
+    for entry_point, hash in entry_points.items():
+        try:
+            load_entry_point(entry_point, hash)
+        except BaseException:
+            print(f'Failed to preload {entry_point}')
+            traceback.print_exc()
+    return { 'loaded': _loaded() }
+
+
+def _worker_main(conn: multiprocessing.connection.Connection):
+    conn.send({ 'ready': True })
+    while True:
+        message = conn.recv()
+        if message is None:
+            return
+        command, *args = message
+        conn.send(_preload(*args) if command == 'preload' else _run_job(*args))
+
+
+class Worker:
+    def __init__(self, context: multiprocessing.context.BaseContext, preload: dict[str, str | None] = None) -> None:
+        """Blocks until the process is ready and `preload` entry points are imported"""
+        started = time.perf_counter()
+        self.conn, child_conn = context.Pipe()
+        # Not a daemon, user code may start its own processes
+        self.process = context.Process(target=_worker_main, args=(child_conn,))
+        self.process.start()
+        child_conn.close()
+        self.conn.recv()
+        self.spawn_time = time.perf_counter() - started
+        self.tasks_run = 0
+        # Entry point -> source hash imported in the process
+        self.loaded: dict[str, str] = { }
+        if preload:
+            self.conn.send(('preload', preload))
+            self.loaded = self.conn.recv()['loaded']
+
+    async def run(self, task_id: int, entry_point: str, hash: str | None, threads: concurrent.futures.Executor) -> dict:
+        """Raises `EOFError` when the process dies or is terminated meanwhile"""
+        self.tasks_run += 1
+        self.conn.send(('run', task_id, entry_point, hash))
+        result = await asyncio.get_running_loop().run_in_executor(threads, self.conn.recv)
+        self.loaded = result['loaded']
+        return result
+
+    def has_loaded(self, entry_point: str, hash: str | None) -> bool:
+        return entry_point in self.loaded and (hash is None or self.loaded[entry_point] == hash)
+
+    def kill(self, grace: float = 5):
+        self.process.terminate()
+        self.process.join(grace)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(5)
+        if self.process.is_alive():
+            self.kill()
+        self.conn.close()
+
+
+class Job:
+    def __init__(self, task_id: int, entry_point: str, source_hash: str | None, priority: int, timeout: float | None, seq: int) -> None:
+        self.task_id = task_id
+        self.entry_point = entry_point
+        self.source_hash = source_hash
+        self.priority = priority
+        self.timeout = timeout
+        self.seq = seq
+        self.state = JobState.queued
+        self.queued_at = datetime.datetime.now()
+        self.started_at: datetime.datetime = None
+        self.finished_at: datetime.datetime = None
+        self.usage: dict = None
+        self.error: str = None
+        self.runner: asyncio.Task = None
+
+    @property
+    def key(self) -> tuple[int, int]:
+        return (-self.priority, self.seq)
+
+
+class TaskExecutor:
+    def __init__(
+        self,
+        max_concurrency: int = None,
+        isolation: str = None,
+        timeout: float = None,
+        max_tasks_per_worker: int = None,
+        warm_workers: int = None,
+        preload: list[str] = None,
+        finished_jobs_kept: int = 1000,
+    ) -> None:
+        self.max_concurrency = max_concurrency or config['agentMaxConcurrency'] or multiprocessing.cpu_count()
+        self.isolation = isolation or config['agentIsolation']
+        self.timeout = timeout if timeout is not None else config['agentTaskTimeout']
+        self.max_tasks_per_worker = max_tasks_per_worker or config['agentMaxTasksPerWorker']
+        self.warm_workers = warm_workers if warm_workers is not None else config['agentWarmWorkers']
+        # Entry point -> source hash or `None` for current file, most recent last
+        self.preload: collections.OrderedDict[str, str | None] = collections.OrderedDict(
+            (entry_point, None) for entry_point in (preload if preload is not None else config['agentPreload'])
+        )
+        self.finished_jobs_kept = finished_jobs_kept
+        if self.isolation not in ('process', 'pool'):
+            raise ValueError(f'Unknown isolation {self.isolation!r}, expected "process" or "pool"')
+
+        self.context = multiprocessing.get_context('spawn')
+        # Blocking `recv` of every running job waits in its own thread
+        self.threads = concurrent.futures.ThreadPoolExecutor(self.max_concurrency, thread_name_prefix='logsy-worker')
+        self.jobs: dict[int, Job] = { }
+        self.finished: collections.OrderedDict[int, Job] = collections.OrderedDict()
+        self.queue: list[tuple[tuple[int, int], Job]] = []
+        self.idle_workers: list[Worker] = []
+        self.spawning = 0
+        self.running = 0
+        self.seq = itertools.count()
+        self.changed = asyncio.Condition()
+        self.dispatcher: asyncio.Task = None
+        self.spawners: set[asyncio.Task] = set()
+
+        self.warm_starts = 0
+        self.cold_starts = 0
+        self.startup_time = 0.0
+
+    async def init(self):
+        self.dispatcher = asyncio.create_task(self._dispatch_forever())
+        self._replenish()
+
+    def get(self, task_id: int) -> Job | None:
+        return self.jobs.get(task_id) or self.finished.get(task_id)
+
+    def position(self, job: Job) -> int | None:
+        """Number of queued jobs that run before this one, `None` unless queued"""
+        if job.state != JobState.queued:
+            return None
+        return sum(1 for key, other in self.queue if other.state == JobState.queued and key < job.key)
+
+    def describe(self, job: Job) -> dict:
+        return {
+            'task_id': job.task_id,
+            'entry_point': job.entry_point,
+            'state': job.state.value,
+            'source_hash': job.source_hash,
+            'priority': job.priority,
+            'position': self.position(job),
+            'queued_at': job.queued_at,
+            'started_at': job.started_at,
+            'finished_at': job.finished_at,
+            'usage': job.usage,
+            'error': job.error,
+        }
+
+    async def _notify(self):
+        async with self.changed:
+            self.changed.notify_all()
+
+    async def submit(self, task_id: int, entry_point: str, priority: int = 0, timeout: float = None, source_hash: str = None) -> Job:
+        if task_id in self.jobs:
+            raise ValueError(f'Task {task_id} is already {self.jobs[task_id].state.value}')
+        timeout = timeout if timeout is not None else self.timeout
+        job = Job(task_id, entry_point, source_hash, priority, timeout, next(self.seq))
+        self.jobs[task_id] = job
+        self.finished.pop(task_id, None)
+        heapq.heappush(self.queue, (job.key, job))
+        await self._notify()
+        return job
+
+    async def cancel(self, task_id: int) -> Job | None:
+        job = self.jobs.get(task_id)
+        if job is None:
+            return self.get(task_id)
+        if job.state == JobState.queued:
+            # Stays in the heap, dispatcher skips it
+            self._finish(job, JobState.cancelled)
+            await self._abort(job, 'Cancelled')
+        elif job.runner:
+            job.runner.cancel()
+            await asyncio.gather(job.runner, return_exceptions=True)
+        return job
+
+    def _finish(self, job: Job, state: JobState):
+        job.state = state
+        job.finished_at = datetime.datetime.now()
+        self.jobs.pop(job.task_id, None)
+        self.finished[job.task_id] = job
+        while len(self.finished) > self.finished_jobs_kept:
+            self.finished.popitem(last=False)
+
+    async def _abort(self, job: Job, message: str):
+        job.error = message
+        try:
+            await Task(id=job.task_id).set_exception(message)
+        except Exception as e:
+            print(f'Failed to abort task {job.task_id}', e)
+
+    def _next_job(self) -> Job | None:
+        while self.queue:
+            _, job = heapq.heappop(self.queue)
+            if job.state == JobState.queued:
+                return job
+        return None
+
+    def _has_work(self) -> bool:
+        while self.queue and self.queue[0][1].state != JobState.queued:
+            heapq.heappop(self.queue)
+        return bool(self.queue) and self.running < self.max_concurrency
+
+    async def _dispatch_forever(self):
+        while True:
+            async with self.changed:
+                await self.changed.wait_for(self._has_work)
+                job = self._next_job()
+                self.running += 1
+                job.state = JobState.running
+                job.started_at = datetime.datetime.now()
+                job.runner = asyncio.create_task(self._run(job))
+
+    def _replenish(self):
+        """Pre-fork workers in background until `warm_workers` are idle or starting"""
+        while len(self.idle_workers) + self.spawning < self.warm_workers:
+            self.spawning += 1
+            spawner = asyncio.create_task(self._spawn())
+            self.spawners.add(spawner)
+            spawner.add_done_callback(self.spawners.discard)
+
+    async def _spawn(self):
+        try:
+            worker = await asyncio.to_thread(Worker, self.context, dict(self.preload))
+            # Warm worker has no spawn cost for the task it runs
+            worker.spawn_time = 0.0
+            self.idle_workers.append(worker)
+        except Exception as e:
+            print('Failed to start worker', e)
+        finally:
+            self.spawning -= 1
+
+    async def _acquire_worker(self, job: Job) -> Worker:
+        if self.idle_workers:
+            warm = [worker for worker in self.idle_workers if worker.has_loaded(job.entry_point, job.source_hash)]
+            worker = warm[-1] if warm else self.idle_workers[-1]
+            self.idle_workers.remove(worker)
+            return worker
+        spawn = asyncio.ensure_future(asyncio.to_thread(Worker, self.context))
+        try:
+            return await asyncio.shield(spawn)
+        except asyncio.CancelledError:
+            # The thread still starts the process, stop it instead of leaking it
+            with contextlib.suppress(Exception):
+                worker = await spawn
+                await asyncio.to_thread(worker.kill)
+            raise
+
+    async def _release_worker(self, worker: Worker):
+        if self.isolation == 'pool' and worker.tasks_run < self.max_tasks_per_worker and worker.process.is_alive():
+            worker.spawn_time = 0.0
+            self.idle_workers.append(worker)
+        else:
+            await asyncio.to_thread(worker.stop)
+        self._replenish()
+
+    def _remember(self, job: Job):
+        self.preload.pop(job.entry_point, None)
+        self.preload[job.entry_point] = job.source_hash
+        while len(self.preload) > max(RECENT_ENTRY_POINTS, len(config['agentPreload'])):
+            self.preload.popitem(last=False)
+
+    def _account_startup(self, job: Job, worker: Worker):
+        startup_time = worker.spawn_time + job.usage['import_time']
+        job.usage['spawn_time'] = worker.spawn_time
+        job.usage['startup_time'] = startup_time
+        job.usage['queue_time'] = (job.started_at - job.queued_at).total_seconds()
+        job.usage['warm'] = startup_time == 0
+        if job.usage['warm']:
+            self.warm_starts += 1
+        else:
+            self.cold_starts += 1
+        self.startup_time += startup_time
+
+    async def _run(self, job: Job):
+        """Re-raises `CancelledError` after the job is recorded and aborted, so `close` can stop runners"""
+        started = time.perf_counter()
+        worker = None
+        try:
+            worker = await self._acquire_worker(job)
+            result = await asyncio.wait_for(worker.run(job.task_id, job.entry_point, job.source_hash, self.threads), job.timeout)
+            job.usage = result['usage']
+            job.error = result['error']
+            self._account_startup(job, worker)
+            self._remember(job)
+            self._finish(job, JobState.failed if job.error else JobState.completed)
+            released, worker = worker, None
+            await self._release_worker(released)
+        except (asyncio.TimeoutError, asyncio.CancelledError, EOFError, OSError) as e:
+            if job.state != JobState.running:
+                # Interrupted while releasing the worker of a finished job
+                raise
+            exitcode = None
+            if worker:
+                killed, worker = worker, None
+                await asyncio.to_thread(killed.kill)
+                exitcode = killed.process.exitcode
+                self._replenish()
+            job.usage = { 'wall_time': time.perf_counter() - started }
+            if isinstance(e, asyncio.TimeoutError):
+                self._finish(job, JobState.timed_out)
+                await self._abort(job, f'Timed out after {job.timeout} seconds')
+            elif isinstance(e, asyncio.CancelledError):
+                self._finish(job, JobState.cancelled)
+                await self._abort(job, 'Cancelled')
+                raise
+            else:
+                self._finish(job, JobState.failed)
+                await self._abort(job, f'Worker process exited with code {exitcode}')
+        finally:
+            if worker:
+                # Unexpected error, nothing else owns the worker
+                await asyncio.to_thread(worker.kill)
+            self.running -= 1
+            await self._notify()
+
+    def metrics(self) -> dict:
+        return {
+            'max_concurrency': self.max_concurrency,
+            'isolation': self.isolation,
+            'running': self.running,
+            'queued': sum(1 for job in self.jobs.values() if job.state == JobState.queued),
+            'idle_workers': len(self.idle_workers),
+            'warm_starts': self.warm_starts,
+            'cold_starts': self.cold_starts,
+            'startup_time_avg': self.startup_time / max(1, self.warm_starts + self.cold_starts),
+        }
+
+    async def close(self):
+        self.warm_workers = 0
+        if self.dispatcher:
+            self.dispatcher.cancel()
+            await asyncio.gather(self.dispatcher, return_exceptions=True)
+        await asyncio.gather(*self.spawners, return_exceptions=True)
+        for job in list(self.jobs.values()):
+            await self.cancel(job.task_id)
+        for worker in self.idle_workers:
+            await asyncio.to_thread(worker.stop)
+        self.idle_workers = []
+        self.threads.shutdown(wait=False)
@@ -0,0 +1,164 @@
+"""
+Read-through cache of hot lookups: tasks, objects and groups by id, and object pages of a task.
+
+Values are loaded from Postgres on a miss and kept in a pluggable backend, in-process LRU
+with TTL and size bound by default (`CACHE_BACKEND=none` disables caching). Entries are
+invalidated by `task:*`/`object:*` events, right after commit of the local transaction that
+produced them and again when they come from the exchange, which also covers other replicas.
+TTL bounds staleness of changes without events.
+
+Object pages are keyed by a version of their task, so one `object:*` event drops every
+cached page of the task without tracking them.
+"""
+import collections
+import itertools
+import time
+import typing
+
+from events import EventType
+import serialization
+import settings
+
+
+MISSING = object()
+
+
+class AbstractCache:
+    """Backend interface, `get` returns `MISSING` for absent or expired keys"""
+    def get(self, key: typing.Hashable) -> typing.Any: return MISSING
+    def set(self, key: typing.Hashable, value: typing.Any): pass
+    def delete(self, key: typing.Hashable): pass
+    def clear(self): pass
+    def metrics(self) -> dict: return { }
+
+
+class LRUCache(AbstractCache):
+    def __init__(self, max_size: int, ttl: float) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        # key -> (expires at, value), least recently used first
+        self.entries: collections.OrderedDict[typing.Hashable, tuple[float, typing.Any]] = collections.OrderedDict()
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: typing.Hashable) -> typing.Any:
+        entry = self.entries.get(key)
+        if entry is None:
+            return MISSING
+        if entry[0] < time.monotonic():
+            del self.entries[key]
+            self.expirations += 1
+            return MISSING
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def set(self, key: typing.Hashable, value: typing.Any):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def delete(self, key: typing.Hashable):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+    def metrics(self) -> dict:
+        return {
+            'size': len(self.entries),
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
+
+
+class ReadThroughCache:
+    def __init__(self, backend: AbstractCache) -> None:
+        self.backend = backend
+        # key -> [loads in flight, invalidations of the key since], a load that raced with
+        # an invalidation of its own key is not stored
+        self.loading: dict[typing.Hashable, list[int]] = { }
+        # Bumped when the whole cache is cleared
+        self.generation = 0
+        self.versions = itertools.count(1)
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    async def get(self, key: typing.Hashable, load: typing.Callable[[], typing.Awaitable[typing.Any]]) -> typing.Any:
+        """Cached value or result of `load()`, `None` results are not cached"""
+        value = self.backend.get(key)
+        if value is not MISSING:
+            self.hits += 1
+            return value
+
+        self.misses += 1
+        state = self.loading.setdefault(key, [0, 0])
+        state[0] += 1
+        invalidations, generation = state[1], self.generation
+        try:
+            value = await load()
+        finally:
+            state[0] -= 1
+            if not state[0]:
+                del self.loading[key]
+        if value is not None and invalidations == state[1] and generation == self.generation:
+            self.backend.set(key, value)
+        return value
+
+    def version(self, tag: typing.Hashable) -> int:
+        """Current version of `tag` to put into keys of entries dropped together"""
+        key = ('version', tag)
+        version = self.backend.get(key)
+        if version is MISSING:
+            # Fresh number, entries keyed by an evicted version are never reached again
+            version = next(self.versions)
+            self.backend.set(key, version)
+        return version
+
+    def _bump(self, tag: typing.Hashable):
+        # Pages loading under the previous version are stored under keys nothing reads anymore
+        self.backend.set(('version', tag), next(self.versions))
+
+    def _delete(self, key: typing.Hashable):
+        self.backend.delete(key)
+        if key in self.loading:
+            self.loading[key][1] += 1
+
+    def invalidate(self, type: str, instance: dict, task_id: int | None):
+        self.invalidations += 1
+        id = instance.get('id')
+        if type in (EventType.TaskCreated.value, EventType.TaskUpdated.value, EventType.TaskProgress.value):
+            self._delete(('task', id))
+        elif type in (EventType.ObjectCreated.value, EventType.ObjectUpdated.value):
+            self._delete(('object', id))
+            if task_id is None:
+                self.generation += 1
+                self.backend.clear()
+            else:
+                self._bump(('objects', task_id))
+
+    def on_event(self, body: bytes):
+        """Events queue listener, `body` is JSON of `models.Event`"""
+        event = serialization.loads(body)
+        self.invalidate(event['type'], event['instance'], event.get('task_id'))
+
+    def metrics(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0,
+            'invalidations': self.invalidations,
+            **self.backend.metrics(),
+        }
+
+
+def _create_backend() -> AbstractCache:
+    if settings.CACHE_BACKEND == 'none':
+        return AbstractCache()
+    return LRUCache(settings.CACHE_MAX_SIZE, settings.CACHE_TTL)
+
+
+cache = ReadThroughCache(_create_backend())
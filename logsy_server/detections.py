@@ -0,0 +1,186 @@
+"""
+Columnar storage of `detections` objects.
+
+A list of `{ category_name, confidence, bbox: { x, y, width, height } | [x, y, width, height] }`
+is stored as one file of separately zlib-compressed little-endian columns: `category`
+(codes into the header's category names), `confidence`, `x`, `y`, `width`, `height`.
+Confidences and bboxes are float32 and read back with 7 significant digits, so logged
+values up to that precision (e.g. 0.5, 0.85, 123.25) come back exactly and thresholds
+compare against what was logged. The JSON header has NumPy dtypes, offsets and sizes of
+the columns, so a query reads and inflates only `category` and `confidence`, and bbox
+columns only of files with matches.
+
+Per category counts and max confidence go to the `detection_summary` table, so queries
+across tasks only open files that have matching detections.
+"""
+import array
+import json
+import math
+import os
+import struct
+import sys
+import typing
+import zlib
+
+import settings
+
+
+MAGIC = b'LDET\x01'
+FILE_EXTENSION = '.ldet'
+BBOX_COLUMNS = ('x', 'y', 'width', 'height')
+COLUMNS = ('category', 'confidence', *BBOX_COLUMNS)
+# Largest finite float32
+FLOAT32_MAX = 3.4028234663852886e38
+
+_DTYPES = { 'H': '<u2', 'I': '<u4', 'f': '<f4' }
+
+
+class Detection(typing.NamedTuple):
+    category_name: str
+    confidence: float
+    bbox: tuple[float, float, float, float]
+
+
+def parse(items: typing.Any) -> list[Detection]:
+    """
+    Raises `ValueError` for anything but a list of detections with confidence in [0, 1],
+    finite bbox values in float32 range and non-negative width and height
+    """
+    if not isinstance(items, list):
+        raise ValueError('Detections should be a list')
+    detections = []
+    for index, item in enumerate(items):
+        try:
+            bbox = item['bbox']
+            if isinstance(bbox, dict):
+                bbox = tuple(bbox[name] for name in BBOX_COLUMNS)
+            if len(bbox) != 4:
+                raise ValueError('bbox should have 4 values')
+            confidence = float(item['confidence'])
+            bbox = tuple(float(value) for value in bbox)
+            if not 0 <= confidence <= 1:
+                raise ValueError('confidence should be in [0, 1]')
+            if not all(abs(value) <= FLOAT32_MAX for value in bbox):
+                raise ValueError('bbox values should be finite float32 numbers')
+            if bbox[2] < 0 or bbox[3] < 0:
+                raise ValueError('bbox width and height should not be negative')
+            detections.append(Detection(str(item['category_name']), confidence, bbox))
+        except (KeyError, TypeError, ValueError) as e:
+            raise ValueError(f'Invalid detection {index}: {e!r}')
+    return detections
+
+
+def _column(values: list, typecode: str) -> tuple[bytes, dict]:
+    column = array.array(typecode, values)
+    if sys.byteorder == 'big':
+        column.byteswap()
+    return zlib.compress(column.tobytes()), { 'dtype': _DTYPES[typecode] }
+
+
+def encode(detections: list[Detection]) -> tuple[bytes, dict[str, tuple[int, float]]]:
+    """File content and `{ category: (count, max confidence) }` of values as they are read back"""
+    categories = list(dict.fromkeys(detection.category_name for detection in detections))
+    codes = { category: code for code, category in enumerate(categories) }
+    values = {
+        'category': [codes[detection.category_name] for detection in detections],
+        'confidence': [detection.confidence for detection in detections],
+        **{ name: [detection.bbox[index] for detection in detections] for index, name in enumerate(BBOX_COLUMNS) },
+    }
+
+    blocks = []
+    columns = { }
+    offset = 0
+    for name in COLUMNS:
+        if name == 'category':
+            block, spec = _column(values[name], 'H' if len(categories) <= 0xffff else 'I')
+        else:
+            block, spec = _column(values[name], 'f')
+        columns[name] = { **spec, 'offset': offset, 'size': len(block) }
+        blocks.append(block)
+        offset += len(block)
+
+    header = json.dumps({ 'count': len(detections), 'categories': categories, 'columns': columns }).encode()
+
+    summary = { }
+    confidences = _decode_values(array.array('f', values['confidence']), columns['confidence'])
+    for code, confidence in zip(values['category'], confidences):
+        count, max_confidence = summary.get(categories[code], (0, -math.inf))
+        summary[categories[code]] = (count + 1, max(max_confidence, confidence))
+    return MAGIC + struct.pack('<I', len(header)) + header + b''.join(blocks), summary
+
+
+def _decode_values(values: typing.Sequence, spec: dict) -> list:
+    if spec['dtype'] == '<f4':
+        # Shortest repr that round-trips float32, 0.1 instead of 0.10000000149011612
+        return [float(f'{value:.7g}') for value in values]
+    return list(values)
+
+
+class DetectionsFile:
+    def __init__(self, path: str) -> None:
+        self.file = open(os.path.join(settings.STORAGE_DIRECTORY, path), 'rb')
+        if self.file.read(len(MAGIC)) != MAGIC:
+            self.file.close()
+            raise ValueError(f'{path} is not a detections file')
+        header_size, = struct.unpack('<I', self.file.read(4))
+        header = json.loads(self.file.read(header_size))
+        self.data_offset = len(MAGIC) + 4 + header_size
+        self.count: int = header['count']
+        self.categories: list[str] = header['categories']
+        self.columns: dict[str, dict] = header['columns']
+
+    def read(self, name: str) -> list:
+        spec = self.columns[name]
+        self.file.seek(self.data_offset + spec['offset'])
+        column = array.array({ dtype: typecode for typecode, dtype in _DTYPES.items() }[spec['dtype']])
+        column.frombytes(zlib.decompress(self.file.read(spec['size'])))
+        if sys.byteorder == 'big':
+            column.byteswap()
+        return _decode_values(column, spec)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def query(path: str, categories: typing.Collection[str] = None, min_confidence: float = 0) -> list[dict]:
+    """Matching detections of one file, each with its `index` in the stored list"""
+    with DetectionsFile(path) as file:
+        codes = None
+        if categories:
+            codes = { code for code, category in enumerate(file.categories) if category in categories }
+            if not codes:
+                return []
+
+        category_column = file.read('category')
+        confidence_column = file.read('confidence')
+        indices = [
+            index for index, (code, confidence) in enumerate(zip(category_column, confidence_column))
+            if confidence >= min_confidence and (codes is None or code in codes)
+        ]
+        if not indices:
+            return []
+
+        bbox_columns = [file.read(name) for name in BBOX_COLUMNS]
+        return [
+            {
+                'index': index,
+                'category_name': file.categories[category_column[index]],
+                'confidence': confidence_column[index],
+                'bbox': { name: column[index] for name, column in zip(BBOX_COLUMNS, bbox_columns) },
+            }
+            for index in indices
+        ]
+
+
+def decode(path: str) -> list[dict]:
+    """Whole stored list in the logged shape"""
+    return [
+        { key: value for key, value in detection.items() if key != 'index' }
+        for detection in query(path)
+    ]
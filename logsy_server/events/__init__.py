@@ -1,2 +1,5 @@
 from .events_queue import events_queue
 from .models import EventType
+from .outbox import outbox_relay
+from .broadcast import broadcaster
+from .throttle import progress_throttle
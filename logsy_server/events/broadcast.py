@@ -0,0 +1,89 @@
+"""
+Fan-out of events to Server-Sent Events subscribers.
+
+Each event is encoded into an SSE frame once and put into bounded per-subscriber
+queues, indexed by task so a publish only touches interested subscribers.
+A subscriber that falls behind has its backlog dropped and gets a `resync`
+event, telling the client to refetch state instead of slowing everyone down.
+"""
+import asyncio
+import collections
+import json
+import typing
+
+import settings
+
+
+RESYNC_FRAME = b'event: resync\ndata: {}\n\n'
+HEARTBEAT_FRAME = b': heartbeat\n\n'
+
+
+class Subscriber:
+    def __init__(self, task_id: int | None) -> None:
+        self.task_id = task_id
+        self.queue: asyncio.Queue[bytes] = asyncio.Queue(maxsize=settings.SSE_SUBSCRIBER_BUFFER)
+
+    def send(self, frame: bytes) -> bool:
+        try:
+            self.queue.put_nowait(frame)
+            return True
+        except asyncio.QueueFull:
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(RESYNC_FRAME)
+            return False
+
+
+class EventBroadcaster:
+    def __init__(self) -> None:
+        # Subscribers by task id, `None` key is for subscribers of all events
+        self.subscribers: dict[int | None, set[Subscriber]] = collections.defaultdict(set)
+        self.lagged = 0
+
+    def subscribe(self, task_id: int = None) -> Subscriber:
+        subscriber = Subscriber(task_id)
+        self.subscribers[task_id].add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        subscribers = self.subscribers.get(subscriber.task_id)
+        if subscribers is not None:
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del self.subscribers[subscriber.task_id]
+
+    def publish(self, body: bytes):
+        """Events queue listener, `body` is JSON of `models.Event`"""
+        if not self.subscribers:
+            return
+
+        event = json.loads(body)
+        task_id = event.get('task_id')
+        frame = b'event: ' + event['type'].encode() + b'\ndata: ' + body + b'\n\n'
+
+        targets = list(self.subscribers.get(None, ()))
+        if task_id is not None:
+            targets.extend(self.subscribers.get(task_id, ()))
+        for subscriber in targets:
+            if not subscriber.send(frame):
+                self.lagged += 1
+
+    async def stream(self, subscriber: Subscriber) -> typing.AsyncIterator[bytes]:
+        try:
+            yield f'retry: {settings.SSE_RETRY_MS}\n\n'.encode()
+            while True:
+                try:
+                    yield await asyncio.wait_for(subscriber.queue.get(), settings.SSE_HEARTBEAT_INTERVAL)
+                except asyncio.TimeoutError:
+                    yield HEARTBEAT_FRAME
+        finally:
+            self.unsubscribe(subscriber)
+
+    def metrics(self) -> dict:
+        return {
+            'subscribers': sum(len(subscribers) for subscribers in self.subscribers.values()),
+            'lagged': self.lagged,
+        }
+
+
+broadcaster = EventBroadcaster()
@@ -0,0 +1,308 @@
+"""
+Durable consumers of `logsy-events` for indexers, notifiers, metrics and alike.
+
+    consumer = EventConsumer('logsy-indexer')
+
+    @consumer.handler(EventType.ObjectCreated, EventType.ObjectUpdated)
+    async def index(event: models.Event): ...
+
+    await consumer.run()
+
+Each consumer owns a durable named queue bound to the events exchange, so events published
+while it is down wait for it. Up to `prefetch` unacknowledged messages are delivered at once
+and handled by `concurrency` lanes, events of one task always go to the same lane and are
+handled in order. Settled deliveries are acknowledged in batches with `multiple=True` once
+every earlier delivery is settled. Events whose handlers keep failing after retries, or that
+can not be parsed, are rejected into the `{name}.dead` queue.
+
+Delivery is at least once, handlers should be idempotent.
+
+Throughput benchmark on the in-memory broker: `python -m events.consumer`
+"""
+import argparse
+import asyncio
+import collections
+import datetime
+import itertools
+import logging
+import time
+import typing
+
+import aio_pika
+import pydantic
+
+from . import models
+import settings
+
+Handler = typing.Callable[[models.Event], typing.Awaitable[None]]
+
+
+class _AckTracker:
+    """Turns out of order completions of one channel into cumulative acks of the settled prefix"""
+    def __init__(self) -> None:
+        self.unsettled: collections.deque[int] = collections.deque()
+        # Settled but not yet acknowledged, `None` for rejected messages
+        self.settled: dict[int, aio_pika.abc.AbstractIncomingMessage | None] = { }
+        self.ack_message = None
+        self.pending = 0
+        self.last_tag = 0
+
+    def received(self, delivery_tag: int):
+        self.unsettled.append(delivery_tag)
+        self.last_tag = delivery_tag
+
+    def settle(self, delivery_tag: int, message: aio_pika.abc.AbstractIncomingMessage | None) -> int:
+        """Returns number of messages an ack sent now would cover"""
+        self.settled[delivery_tag] = message
+        while self.unsettled and self.unsettled[0] in self.settled:
+            prefix_message = self.settled.pop(self.unsettled.popleft())
+            # Rejected tags are already settled on the broker, acking them is an error
+            if prefix_message is not None:
+                self.ack_message = prefix_message
+                self.pending += 1
+        return self.pending
+
+    def take(self) -> aio_pika.abc.AbstractIncomingMessage | None:
+        message, self.ack_message, self.pending = self.ack_message, None, 0
+        return message
+
+
+class EventConsumer:
+    def __init__(
+        self,
+        name: str,
+        connect: typing.Callable[[str], typing.Awaitable[aio_pika.abc.AbstractConnection]] = None,
+        prefetch: int = None,
+        concurrency: int = None,
+        ack_batch_size: int = None,
+    ) -> None:
+        self.name = name
+        self.connect = connect or _broker_connect()
+        self.prefetch = prefetch or settings.CONSUMER_PREFETCH
+        self.concurrency = concurrency or settings.CONSUMER_CONCURRENCY
+        # Ack batch must be smaller than prefetch, otherwise the broker stops delivering before it fills
+        self.ack_batch_size = max(1, min(ack_batch_size or settings.CONSUMER_ACK_BATCH_SIZE, self.prefetch // 2))
+        self.handlers: dict[models.EventType, list[Handler]] = collections.defaultdict(list)
+
+        self.connection = None
+        self.queue = None
+        self.consumer_tag = None
+        self.lanes: list[asyncio.Queue] = []
+        self.workers: list[asyncio.Task] = []
+        self.acker: asyncio.Task = None
+        self.ack_lock = asyncio.Lock()
+        self.tracker = _AckTracker()
+        # Bumped when the channel is recovered, deliveries of the old channel are redelivered by the broker
+        self.generation = 0
+        self.round_robin = itertools.count()
+
+        self.received = 0
+        self.handled = 0
+        self.retries = 0
+        self.dead_lettered = 0
+        self.acks = 0
+
+    def add_handler(self, handler: Handler, *types: models.EventType):
+        for type in types or tuple(models.EventType):
+            self.handlers[type].append(handler)
+
+    def handler(self, *types: models.EventType):
+        """Decorator, handler gets events of `types` or of every type when none are given"""
+        def register(handler: Handler) -> Handler:
+            self.add_handler(handler, *types)
+            return handler
+        return register
+
+    async def start(self):
+        self.connection = await self.connect(settings.RQ_CONNECTION_STRING)
+        channel = await self.connection.channel()
+        await channel.set_qos(prefetch_count=self.prefetch)
+
+        exchange = await channel.declare_exchange(settings.RQ_EXCHANGE_NAME, aio_pika.ExchangeType.FANOUT)
+        dead_exchange = await channel.declare_exchange(f'{self.name}.dead', aio_pika.ExchangeType.FANOUT, durable=True)
+        dead_queue = await channel.declare_queue(f'{self.name}.dead', durable=True)
+        await dead_queue.bind(dead_exchange)
+
+        self.queue = await channel.declare_queue(
+            self.name,
+            durable=True,
+            arguments={ 'x-dead-letter-exchange': f'{self.name}.dead' }
+        )
+        await self.queue.bind(exchange)
+
+        self.lanes = [asyncio.Queue() for _ in range(self.concurrency)]
+        self.workers = [asyncio.create_task(self._work(lane)) for lane in self.lanes]
+        self.acker = asyncio.create_task(self._ack_forever())
+        self.consumer_tag = await self.queue.consume(self._on_message)
+        logging.info('Consumer %s is waiting for events', self.name)
+
+    async def run(self):
+        await self.start()
+        try:
+            await asyncio.Future()
+        finally:
+            await self.close()
+
+    def _lane(self, event: models.Event) -> asyncio.Queue:
+        key = event.task_id if event.task_id is not None else next(self.round_robin)
+        return self.lanes[key % len(self.lanes)]
+
+    async def _on_message(self, message: aio_pika.abc.AbstractIncomingMessage):
+        if message.delivery_tag <= self.tracker.last_tag:
+            # Tags restarted, robust connection recovered the channel
+            self.generation += 1
+            self.tracker = _AckTracker()
+        self.tracker.received(message.delivery_tag)
+        self.received += 1
+
+        try:
+            event = models.Event.model_validate_json(message.body)
+        except pydantic.ValidationError:
+            logging.exception('Invalid event %r', message.body[:200])
+            await self._settle(self.generation, message, False)
+            return
+        self._lane(event).put_nowait((self.generation, message, event))
+
+    async def _handle(self, event: models.Event) -> bool:
+        handlers = self.handlers.get(event.type, [])
+        for attempt in range(settings.CONSUMER_MAX_RETRIES + 1):
+            try:
+                await asyncio.gather(*(handler(event) for handler in handlers))
+                return True
+            except Exception:
+                logging.exception('Handling %s failed, attempt %s', event.type.value, attempt + 1)
+                if attempt < settings.CONSUMER_MAX_RETRIES:
+                    self.retries += 1
+                    await asyncio.sleep(settings.CONSUMER_RETRY_DELAY * 2 ** attempt)
+        return False
+
+    async def _work(self, lane: asyncio.Queue):
+        while True:
+            generation, message, event = await lane.get()
+            try:
+                await self._settle(generation, message, await self._handle(event))
+            except Exception:
+                logging.exception('Can not settle event %s', event.type.value)
+            finally:
+                lane.task_done()
+
+    async def _settle(self, generation: int, message: aio_pika.abc.AbstractIncomingMessage, handled: bool):
+        if generation != self.generation:
+            return
+        if handled:
+            self.handled += 1
+        else:
+            self.dead_lettered += 1
+            await message.reject(requeue=False)
+        if self.tracker.settle(message.delivery_tag, message if handled else None) >= self.ack_batch_size:
+            await self._flush_acks()
+
+    async def _flush_acks(self):
+        # Lock keeps cumulative acks in tag order
+        async with self.ack_lock:
+            message = self.tracker.take()
+            if message:
+                await message.ack(multiple=True)
+                self.acks += 1
+
+    async def _ack_forever(self):
+        while True:
+            await asyncio.sleep(settings.CONSUMER_ACK_INTERVAL)
+            try:
+                await self._flush_acks()
+            except Exception:
+                logging.exception('Can not acknowledge events')
+
+    def metrics(self) -> dict:
+        return {
+            'received': self.received,
+            'handled': self.handled,
+            'in_flight': self.received - self.handled - self.dead_lettered,
+            'retries': self.retries,
+            'dead_lettered': self.dead_lettered,
+            'acks': self.acks,
+        }
+
+    async def close(self):
+        """Stop receiving, finish events already delivered and acknowledge them"""
+        if self.consumer_tag:
+            await self.queue.cancel(self.consumer_tag)
+            self.consumer_tag = None
+        try:
+            await asyncio.wait_for(asyncio.gather(*(lane.join() for lane in self.lanes)), settings.EVENTS_CLOSE_TIMEOUT)
+        except asyncio.TimeoutError:
+            logging.warning('Consumer %s closed with unhandled events, they will be redelivered', self.name)
+        await self._flush_acks()
+        for task in [*self.workers, self.acker]:
+            if task:
+                task.cancel()
+        await asyncio.gather(*self.workers, *([self.acker] if self.acker else []), return_exceptions=True)
+        self.workers, self.acker = [], None
+        if self.connection:
+            await self.connection.close()
+            self.connection = None
+
+
+def _broker_connect():
+    if settings.EVENTS_BROKER == 'memory':
+        from .memory_broker import broker
+        return broker.connect
+    # Robust connection restores channel, queues and consumer after broker restarts
+    return aio_pika.connect_robust
+
+
+async def benchmark(events: int, prefetch: int, concurrency: int, ack_batch_size: int, handler_delay: float) -> tuple[float, dict]:
+    from .memory_broker import InMemoryBroker
+
+    broker = InMemoryBroker()
+    consumer = EventConsumer('logsy-benchmark', broker.connect, prefetch, concurrency, ack_batch_size)
+    done = asyncio.Event()
+    handled = 0
+
+    @consumer.handler()
+    async def handle(event: models.Event):
+        nonlocal handled
+        # Stands for IO of a real handler, e.g. a write to a search index
+        await asyncio.sleep(handler_delay)
+        handled += 1
+        if handled == events:
+            done.set()
+
+    await consumer.start()
+    connection = await broker.connect()
+    exchange = await (await connection.channel()).declare_exchange(settings.RQ_EXCHANGE_NAME)
+
+    start = time.perf_counter()
+    for id in range(events):
+        body = models.Event(
+            time=datetime.datetime.now(),
+            type=models.EventType.ObjectCreated,
+            instance={ 'id': id },
+            task_id=id % 100
+        ).model_dump_json().encode()
+        await exchange.publish(aio_pika.Message(body=body), 'logsy-event')
+    await done.wait()
+    elapsed = time.perf_counter() - start
+
+    await consumer.close()
+    await connection.close()
+    return events / elapsed, consumer.metrics()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Event consumer throughput on the in-memory broker')
+    parser.add_argument('--events', type=int, default=20000)
+    parser.add_argument('--handler-delay', type=float, default=0.001, help='Seconds each handler awaits')
+    args = parser.parse_args()
+
+    # First row is one event at a time with an ack per event, like the former rqconsumer
+    for prefetch, concurrency, ack_batch_size in [(1, 1, 1), (32, 8, 16), (256, 32, 64), (1024, 128, 256)]:
+        events = args.events if concurrency > 1 else min(args.events, 2000)
+        throughput, metrics = await benchmark(events, prefetch, concurrency, ack_batch_size, args.handler_delay)
+        print(
+            f'prefetch={prefetch:5} concurrency={concurrency:4} ack_batch={ack_batch_size:4}: '
+            f'{throughput:9.0f} events/s, {metrics["acks"]} acks for {events} events'
+        )
+
+if __name__ == "__main__":
+    asyncio.run(main())
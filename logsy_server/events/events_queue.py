@@ -1,6 +1,7 @@
 import asyncio
 import logging
 import datetime
+import typing
 
 from aio_pika import Message, connect
 import aio_pika
@@ -10,42 +11,199 @@ import settings
 
 logging.getLogger().setLevel(logging.INFO)
 
+# (time, type, instance, task_id)
+EventTuple = tuple[datetime.datetime, models.EventType, dict, int | None]
+Listener = typing.Callable[[bytes], None]
+
 class AbstractEventsQueue:
-    def __init__(self) -> None: pass
+    """Listeners get JSON of every `models.Event` published to the exchange, by any replica"""
+    def __init__(self) -> None:
+        self.listeners: list[Listener] = []
+    def add_listener(self, listener: Listener):
+        self.listeners.append(listener)
+    def _notify(self, body: bytes):
+        for listener in self.listeners:
+            try:
+                listener(body)
+            except Exception:
+                logging.exception('Events listener failed')
+    @staticmethod
+    def _event_json(time: datetime.datetime, type: models.EventType, instance: dict, task_id: int = None) -> bytes:
+        return models.Event.model_validate({
+            'time': time,
+            'type': type,
+            'instance': instance,
+            'task_id': task_id
+        }).model_dump_json().encode()
     async def init(self): pass
-    async def produce_event(self, type: models.EventType, instance: dict): pass
+    async def produce_event(self, type: models.EventType, instance: dict, task_id: int = None): pass
+    async def publish(self, events: list[EventTuple]): pass
     async def close(self): pass
+    def metrics(self) -> dict: return { }
 
 class MockEventsQueue(AbstractEventsQueue):
-    pass
+    """No broker, events only reach listeners of this process"""
+    async def produce_event(self, type: models.EventType, instance: dict, task_id: int = None):
+        await self.publish([(datetime.datetime.now(), type, instance, task_id)])
+
+    async def publish(self, events: list[EventTuple]):
+        if self.listeners:
+            for event in events:
+                self._notify(self._event_json(*event))
 
 class RabbitMQEventsQueue(AbstractEventsQueue):
+    """
+    `produce_event` only puts the event into a bounded in-process buffer, so request
+    latency does not depend on the broker. Background publisher takes events in
+    batches, publishes them with publisher confirms and reconnects with backoff.
+    When the buffer is full new events are dropped and counted.
+    """
+
+    def __init__(self, connect: typing.Callable[[str], typing.Awaitable[aio_pika.abc.AbstractConnection]] = connect) -> None:
+        super().__init__()
+        self.connect = connect
+        self.connection = None
+        self.exchange = None
+        self.buffer: asyncio.Queue[EventTuple] = None
+        self.publisher: asyncio.Task = None
+        self.publish_lock = asyncio.Lock()
+        self.dropped = 0
+        self.published = 0
+        self.failed_batches = 0
+        self.reconnects = 0
+
     async def init(self):
-        self.connection = await connect(settings.RQ_CONNECTION_STRING)
+        self.buffer = asyncio.Queue(maxsize=settings.EVENTS_BUFFER_SIZE)
+        await self._connect()
+        self.publisher = asyncio.create_task(self._publish_forever())
 
-        # Creating a channel
-        channel = await self.connection.channel()
+    async def _connect(self):
+        self.connection = await self.connect(settings.RQ_CONNECTION_STRING)
+
+        # Creating a channel, confirms let us know that batch reached the broker
+        channel = await self.connection.channel(publisher_confirms=True)
         self.exchange = await channel.declare_exchange(settings.RQ_EXCHANGE_NAME, aio_pika.ExchangeType.FANOUT)
 
-    async def produce_event(self, type: models.EventType, instance: dict):
-        event_model = models.Event.model_validate({
-            'time': datetime.datetime.now(),
-            'type': type,
-            'instance': instance
-        })
-        await self.exchange.publish(
-            Message(body=event_model.model_dump_json().encode()),
-            "logsy-event"
-        )
+        if self.listeners:
+            # Own queue per process, so listeners see events published by every replica
+            queue = await channel.declare_queue(exclusive=True, auto_delete=True)
+            await queue.bind(self.exchange)
+            await queue.consume(self._on_message, no_ack=True)
+
+    async def _on_message(self, message: aio_pika.abc.AbstractIncomingMessage):
+        self._notify(message.body)
+
+    async def _reconnect(self):
+        attempt = 0
+        while True:
+            delay = min(settings.EVENTS_RECONNECT_MAX_DELAY, settings.EVENTS_RECONNECT_DELAY * 2 ** attempt)
+            await asyncio.sleep(delay)
+            try:
+                if self.connection and not self.connection.is_closed:
+                    await self.connection.close()
+                await self._connect()
+                self.reconnects += 1
+                return
+            except Exception:
+                logging.exception('Can not reconnect to events broker, attempt %s', attempt + 1)
+                attempt += 1
+
+    async def produce_event(self, type: models.EventType, instance: dict, task_id: int = None):
+        try:
+            self.buffer.put_nowait((datetime.datetime.now(), type, instance, task_id))
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    async def _next_batch(self) -> list[EventTuple]:
+        batch = [await self.buffer.get()]
+        deadline = asyncio.get_running_loop().time() + settings.EVENTS_BATCH_DELAY
+        while len(batch) < settings.EVENTS_BATCH_SIZE:
+            if not self.buffer.empty():
+                batch.append(self.buffer.get_nowait())
+                continue
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.buffer.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    @classmethod
+    def _message(cls, time: datetime.datetime, type: models.EventType, instance: dict, task_id: int = None) -> Message:
+        return Message(body=cls._event_json(time, type, instance, task_id), content_type='application/json')
+
+    async def _publish_batch(self, messages: list[Message]):
+        # Publishes are pipelined, each awaits its own broker confirmation
+        await asyncio.gather(*(self.exchange.publish(message, "logsy-event") for message in messages))
+
+    async def publish(self, events: list[EventTuple]):
+        """Publish events in order and wait for broker confirms, reconnecting until it succeeds"""
+        messages = []
+        for event in events:
+            try:
+                messages.append(self._message(*event))
+            except Exception:
+                logging.exception('Invalid event %r', event)
+                self.dropped += 1
+
+        async with self.publish_lock:
+            while messages:
+                try:
+                    await self._publish_batch(messages)
+                    self.published += len(messages)
+                    return
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    # Whole batch is resent, consumers may see duplicates but not losses
+                    logging.exception('Can not publish %s events, reconnecting', len(messages))
+                    self.failed_batches += 1
+                    await self._reconnect()
+
+    async def _publish_forever(self):
+        while True:
+            batch = await self._next_batch()
+            try:
+                await self.publish(batch)
+            finally:
+                for _ in batch:
+                    self.buffer.task_done()
+
+    def metrics(self) -> dict:
+        return {
+            'depth': self.buffer.qsize() if self.buffer else 0,
+            'capacity': settings.EVENTS_BUFFER_SIZE,
+            'dropped': self.dropped,
+            'published': self.published,
+            'failed_batches': self.failed_batches,
+            'reconnects': self.reconnects,
+        }
 
     async def close(self):
-        await self.connection.close()
+        if self.publisher:
+            try:
+                await asyncio.wait_for(self.buffer.join(), settings.EVENTS_CLOSE_TIMEOUT)
+            except asyncio.TimeoutError:
+                logging.warning('Dropping %s unpublished events on close', self.buffer.qsize())
+            self.publisher.cancel()
+            await asyncio.gather(self.publisher, return_exceptions=True)
+        if self.connection:
+            await self.connection.close()
+
+def _broker_connect():
+    if settings.EVENTS_BROKER == 'memory':
+        from .memory_broker import broker
+        return broker.connect
+    return connect
 
-events_queue = RabbitMQEventsQueue() if settings.USE_RABBITMQ_EVENTS else MockEventsQueue()
+events_queue = RabbitMQEventsQueue(_broker_connect()) if settings.USE_RABBITMQ_EVENTS else MockEventsQueue()
 
 async def main():
     await events_queue.init()
     await events_queue.produce_event(models.EventType.TaskCreated, { 'id': 1, 'name': 'None' })
+    await events_queue.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,226 @@
+"""
+In-memory stand-in for the subset of aio_pika used by `RabbitMQEventsQueue` and `EventConsumer`.
+
+Published messages are kept in `broker.messages`, `broker.fail_publishes = n`
+makes next `n` publishes raise to exercise reconnects. Select it with
+`EVENTS_BROKER=memory` or pass `broker.connect` to `RabbitMQEventsQueue`.
+
+Named queues outlive connections like durable ones, unnamed queues are deleted
+with their connection. Channels honour `prefetch_count`, acks with `multiple`,
+rejects and `x-dead-letter-exchange`.
+"""
+import asyncio
+import collections
+import itertools
+
+import aio_pika
+
+
+class InMemoryIncomingMessage:
+    def __init__(self, message: aio_pika.Message, channel: 'InMemoryChannel' = None, delivery_tag: int = 0) -> None:
+        self.body = message.body
+        self.message = message
+        self.channel = channel
+        self.delivery_tag = delivery_tag
+
+    async def ack(self, multiple: bool = False):
+        self.channel.settle(self.delivery_tag, multiple=multiple)
+
+    async def reject(self, requeue: bool = False):
+        self.channel.settle(self.delivery_tag, requeue=requeue, dead=not requeue)
+
+
+class InMemoryConsumer:
+    def __init__(self, channel: 'InMemoryChannel', queue: 'InMemoryQueue', callback, no_ack: bool) -> None:
+        self.channel = channel
+        self.queue = queue
+        self.callback = callback
+        self.no_ack = no_ack
+
+    def deliver(self, message: aio_pika.Message):
+        tag = next(self.channel.delivery_tags)
+        if not self.no_ack:
+            self.channel.unacked[tag] = (self.queue, message)
+        asyncio.get_running_loop().create_task(self.callback(InMemoryIncomingMessage(message, self.channel, tag)))
+
+
+class InMemoryQueue:
+    def __init__(self, broker: 'InMemoryBroker', name: str = None, arguments: dict = None) -> None:
+        self.broker = broker
+        self.name = name
+        self.arguments = arguments or { }
+        self.messages: collections.deque[aio_pika.Message] = collections.deque()
+        self.consumers: list[InMemoryConsumer] = []
+        self.exchanges: list['InMemoryExchange'] = []
+
+    def bind(self, exchange: 'InMemoryExchange'):
+        exchange.queues.append(self)
+        self.exchanges.append(exchange)
+
+    def delete(self):
+        for exchange in self.exchanges:
+            exchange.queues.remove(self)
+        self.exchanges = []
+        self.consumers = []
+
+    def put(self, message: aio_pika.Message):
+        self.messages.append(message)
+        self.dispatch()
+
+    def dispatch(self):
+        """Round robin over consumers whose channels are below prefetch limit"""
+        while self.messages:
+            ready = [consumer for consumer in self.consumers if consumer.channel.has_capacity()]
+            if not ready:
+                return
+            for consumer in ready:
+                if not self.messages or not consumer.channel.has_capacity():
+                    break
+                consumer.deliver(self.messages.popleft())
+
+    def dead_letter(self, message: aio_pika.Message):
+        exchange = self.broker.exchanges.get(self.arguments.get('x-dead-letter-exchange'))
+        if exchange:
+            exchange.route(message)
+
+
+class InMemoryChannelQueue:
+    """Queue as seen through a channel, consumers get the channel's delivery tags and prefetch"""
+    def __init__(self, channel: 'InMemoryChannel', queue: InMemoryQueue) -> None:
+        self.channel = channel
+        self.queue = queue
+        self.name = queue.name
+
+    async def bind(self, exchange: 'InMemoryExchange', routing_key: str = None):
+        self.queue.bind(exchange)
+
+    async def consume(self, callback, no_ack: bool = False) -> str:
+        consumer_tag = f'ctag-{next(self.channel.broker.consumer_tags)}'
+        consumer = InMemoryConsumer(self.channel, self.queue, callback, no_ack)
+        self.channel.consumers[consumer_tag] = consumer
+        self.queue.consumers.append(consumer)
+        self.queue.dispatch()
+        return consumer_tag
+
+    async def cancel(self, consumer_tag: str):
+        consumer = self.channel.consumers.pop(consumer_tag)
+        self.queue.consumers.remove(consumer)
+
+    def delete(self):
+        self.queue.delete()
+
+
+class InMemoryExchange:
+    def __init__(self, broker: 'InMemoryBroker', name: str) -> None:
+        self.broker = broker
+        self.name = name
+        self.queues: list[InMemoryQueue] = []
+
+    async def publish(self, message: aio_pika.Message, routing_key: str):
+        await asyncio.sleep(self.broker.confirm_delay)
+        if self.broker.fail_publishes > 0:
+            self.broker.fail_publishes -= 1
+            raise ConnectionError('In-memory broker publish failure')
+        self.broker.messages.append((self.name, routing_key, message))
+        self.route(message)
+
+    def route(self, message: aio_pika.Message):
+        for queue in self.queues:
+            queue.put(message)
+
+
+class InMemoryChannel:
+    def __init__(self, broker: 'InMemoryBroker', connection: 'InMemoryConnection') -> None:
+        self.broker = broker
+        self.connection = connection
+        self.prefetch_count = 0
+        self.delivery_tags = itertools.count(1)
+        self.unacked: dict[int, tuple[InMemoryQueue, aio_pika.Message]] = { }
+        self.consumers: dict[str, InMemoryConsumer] = { }
+
+    async def set_qos(self, prefetch_count: int = 0, **kwargs):
+        self.prefetch_count = prefetch_count
+
+    def has_capacity(self) -> bool:
+        return not self.prefetch_count or len(self.unacked) < self.prefetch_count
+
+    def settle(self, delivery_tag: int, multiple: bool = False, requeue: bool = False, dead: bool = False):
+        if delivery_tag not in self.unacked:
+            # RabbitMQ closes the channel with PRECONDITION_FAILED here
+            raise RuntimeError(f'Unknown delivery tag {delivery_tag}')
+        tags = [tag for tag in self.unacked if tag <= delivery_tag] if multiple else [delivery_tag]
+        queues = set()
+        for tag in tags:
+            queue, message = self.unacked.pop(tag)
+            if requeue:
+                queue.messages.appendleft(message)
+            elif dead:
+                queue.dead_letter(message)
+            queues.add(queue)
+        for queue in queues:
+            queue.dispatch()
+
+    async def declare_exchange(self, name: str, type: aio_pika.ExchangeType = None, **kwargs) -> InMemoryExchange:
+        return self.broker.exchanges.setdefault(name, InMemoryExchange(self.broker, name))
+
+    async def declare_queue(self, name: str = None, arguments: dict = None, **kwargs) -> InMemoryChannelQueue:
+        if name is None:
+            # Unnamed queues live as long as the connection, like exclusive ones
+            queue = InMemoryQueue(self.broker, arguments=arguments)
+            self.connection.queues.append(queue)
+        else:
+            queue = self.broker.queues.setdefault(name, InMemoryQueue(self.broker, name, arguments))
+        return InMemoryChannelQueue(self, queue)
+
+    def close(self):
+        for consumer in self.consumers.values():
+            consumer.queue.consumers.remove(consumer)
+        self.consumers = { }
+        # Unacknowledged messages go back to their queues, like on a real broker
+        queues = set()
+        for tag in sorted(self.unacked, reverse=True):
+            queue, message = self.unacked.pop(tag)
+            queue.messages.appendleft(message)
+            queues.add(queue)
+        for queue in queues:
+            queue.dispatch()
+
+
+class InMemoryConnection:
+    def __init__(self, broker: 'InMemoryBroker') -> None:
+        self.broker = broker
+        self.is_closed = False
+        self.channels: list[InMemoryChannel] = []
+        self.queues: list[InMemoryQueue] = []
+
+    async def channel(self, **kwargs) -> InMemoryChannel:
+        channel = InMemoryChannel(self.broker, self)
+        self.channels.append(channel)
+        return channel
+
+    async def close(self):
+        for channel in self.channels:
+            channel.close()
+        for queue in self.queues:
+            queue.delete()
+        self.channels = []
+        self.queues = []
+        self.is_closed = True
+
+
+class InMemoryBroker:
+    def __init__(self, confirm_delay: float = 0) -> None:
+        self.messages: list[tuple[str, str, aio_pika.Message]] = []
+        self.exchanges: dict[str, InMemoryExchange] = { }
+        self.queues: dict[str, InMemoryQueue] = { }
+        self.consumer_tags = itertools.count(1)
+        self.fail_publishes = 0
+        self.confirm_delay = confirm_delay
+        self.connections = 0
+
+    async def connect(self, url: str = None) -> InMemoryConnection:
+        self.connections += 1
+        return InMemoryConnection(self)
+
+
+broker = InMemoryBroker()
@@ -6,6 +6,8 @@ import datetime
 class EventType(enum.Enum):
     TaskCreated = 'task:created'
     TaskUpdated = 'task:updated'
+    # `{ id, status, progress }` only, rate limited per task
+    TaskProgress = 'task:progress'
     ObjectCreated = 'object:created'
     ObjectUpdated = 'object:updated'
 
@@ -14,3 +16,5 @@ class Event(pydantic.BaseModel):
     time: datetime.datetime
     type: EventType
     instance: dict
+    # Task the instance belongs to, lets consumers filter events per task
+    task_id: int | None = None
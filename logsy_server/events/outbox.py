@@ -0,0 +1,108 @@
+"""
+Transactional outbox relay.
+
+Request handlers insert events into the outbox table in the same transaction
+as the entity change. `OutboxRelay` reads them in id order, publishes them with
+broker confirms and deletes them afterwards, so a committed change always
+produces its event (at least once) and an aborted one never does.
+
+Only one relay at a time works on the table (session-level advisory lock),
+which keeps events of a task in commit order across API replicas.
+"""
+import asyncio
+import logging
+
+import sqlalchemy
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from .events_queue import AbstractEventsQueue
+from .models import EventType
+import settings
+
+
+OUTBOX_LOCK_KEY = 0x6c6f6773  # "logs"
+
+
+class OutboxRelay:
+    def __init__(self) -> None:
+        self.session_maker: async_sessionmaker = None
+        self.model = None
+        self.events_queue: AbstractEventsQueue = None
+        self.wakeup = asyncio.Event()
+        self.worker: asyncio.Task = None
+        self.relayed = 0
+
+    async def init(self, session_maker: async_sessionmaker, model, events_queue: AbstractEventsQueue):
+        self.session_maker = session_maker
+        self.model = model
+        self.events_queue = events_queue
+        self.worker = asyncio.create_task(self._relay_forever())
+
+    def notify(self):
+        """Wake relay right after a commit with outbox events instead of waiting for the next poll"""
+        self.wakeup.set()
+
+    async def _relay_batch(self) -> int:
+        """
+        Batch is read and deleted in two short transactions with the broker publish in
+        between, so a broker outage holds no transaction open. The session-level lock of
+        the connection keeps other relays out for the whole round.
+        """
+        async with self.session_maker.kw['bind'].connect() as conn:
+            locked = await conn.scalar(sqlalchemy.select(sqlalchemy.func.pg_try_advisory_lock(OUTBOX_LOCK_KEY)))
+            await conn.commit()
+            if not locked:
+                return 0
+            try:
+                rows = (await conn.execute(
+                    sqlalchemy.select(self.model.id, self.model.time, self.model.type, self.model.instance, self.model.task_id)
+                    .order_by(self.model.id)
+                    .limit(settings.OUTBOX_BATCH_SIZE)
+                )).all()
+                await conn.commit()
+                if not rows:
+                    return 0
+
+                # Rows stay until the broker confirmed them, after a timeout the batch is sent again
+                await asyncio.wait_for(self.events_queue.publish([
+                    (time, EventType(type), instance, task_id)
+                    for _, time, type, instance, task_id in rows
+                ]), settings.OUTBOX_PUBLISH_TIMEOUT)
+
+                await conn.execute(sqlalchemy.delete(self.model).where(self.model.id.in_([row.id for row in rows])))
+                await conn.commit()
+            finally:
+                await conn.rollback()
+                await conn.execute(sqlalchemy.select(sqlalchemy.func.pg_advisory_unlock(OUTBOX_LOCK_KEY)))
+                await conn.commit()
+
+        self.relayed += len(rows)
+        return len(rows)
+
+    async def _relay_forever(self):
+        while True:
+            self.wakeup.clear()
+            try:
+                count = await self._relay_batch()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logging.exception('Outbox relay failed')
+                count = 0
+
+            if count < settings.OUTBOX_BATCH_SIZE:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), settings.OUTBOX_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+
+    def metrics(self) -> dict:
+        return { 'relayed': self.relayed }
+
+    async def close(self):
+        if self.worker:
+            self.worker.cancel()
+            await asyncio.gather(self.worker, return_exceptions=True)
+
+
+outbox_relay = OutboxRelay()
@@ -0,0 +1,73 @@
+"""
+Per-key rate limiting of high-frequency events, e.g. task progress.
+
+First event of a key is produced at once and opens a window of `interval` seconds.
+Events submitted during the window only replace the pending one, which is produced
+when the window ends. So every key emits at most one event per interval and the
+latest state always gets out. Limits are per server process.
+"""
+import asyncio
+import logging
+import typing
+
+from . import models
+from .events_queue import AbstractEventsQueue
+import settings
+
+
+class EventThrottle:
+    def __init__(self, interval: float) -> None:
+        self.interval = interval
+        self.queue: AbstractEventsQueue = None
+        # Latest not yet produced event by key
+        self.pending: dict[typing.Hashable, tuple[models.EventType, dict, int | None]] = { }
+        self.windows: dict[typing.Hashable, asyncio.Task] = { }
+        self.submitted = 0
+        self.produced = 0
+
+    async def init(self, queue: AbstractEventsQueue):
+        self.queue = queue
+
+    async def _produce(self, type: models.EventType, instance: dict, task_id: int = None):
+        self.produced += 1
+        await self.queue.produce_event(type, instance, task_id)
+
+    async def submit(self, key: typing.Hashable, type: models.EventType, instance: dict, task_id: int = None):
+        self.submitted += 1
+        if key in self.windows:
+            self.pending[key] = (type, instance, task_id)
+            return
+        self.windows[key] = asyncio.create_task(self._window(key))
+        await self._produce(type, instance, task_id)
+
+    async def _window(self, key: typing.Hashable):
+        try:
+            while True:
+                await asyncio.sleep(self.interval)
+                if key not in self.pending:
+                    return
+                try:
+                    await self._produce(*self.pending.pop(key))
+                except Exception:
+                    logging.exception('Can not produce throttled event')
+        finally:
+            self.windows.pop(key, None)
+
+    def metrics(self) -> dict:
+        return {
+            'submitted': self.submitted,
+            'produced': self.produced,
+            'pending': len(self.pending),
+        }
+
+    async def close(self):
+        """Produce pending events right away"""
+        for window in list(self.windows.values()):
+            window.cancel()
+        await asyncio.gather(*self.windows.values(), return_exceptions=True)
+        pending, self.pending = self.pending, { }
+        for event in pending.values():
+            await self._produce(*event)
+
+
+progress_throttle = EventThrottle(settings.PROGRESS_EVENT_INTERVAL)
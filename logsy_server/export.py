@@ -0,0 +1,57 @@
+"""
+Streaming NDJSON export.
+
+Rows are fetched through a server-side cursor in `settings.EXPORT_BATCH_SIZE`
+partitions and written out one JSON document per line, so memory stays
+constant no matter how many rows are exported.
+"""
+import asyncio
+import os
+import typing
+
+import sqlalchemy
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+import serialization
+import settings
+
+
+NDJSON_MEDIA_TYPE = 'application/x-ndjson'
+
+
+def dumps_line(row: dict) -> bytes:
+    return serialization.dumps(row) + b'\n'
+
+
+def _read_json_files(paths: list[str | None]) -> list:
+    contents = []
+    for path in paths:
+        content = None
+        if path:
+            try:
+                with open(os.path.join(settings.STORAGE_DIRECTORY, path), 'rb') as file:
+                    content = serialization.loads(file.read())
+            except (OSError, ValueError):
+                pass
+        contents.append(content)
+    return contents
+
+
+async def stream_ndjson(
+    engine: AsyncEngine,
+    stmt: sqlalchemy.Select,
+    inline_path: typing.Callable[[dict], str | None] = None,
+) -> typing.AsyncIterator[bytes]:
+    """
+    Yield NDJSON chunks, one per fetched partition. With `inline_path`, JSON file
+    returned for a row is read from storage and put into its `content` field.
+    """
+    async with engine.connect() as connection:
+        result = await connection.stream(stmt.execution_options(yield_per=settings.EXPORT_BATCH_SIZE))
+        async for partition in result.partitions():
+            rows = [dict(row._mapping) for row in partition]
+            if inline_path:
+                contents = await asyncio.to_thread(_read_json_files, [inline_path(row) for row in rows])
+                for row, content in zip(rows, contents):
+                    row['content'] = content
+            yield b''.join(dumps_line(row) for row in rows)
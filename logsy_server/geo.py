@@ -0,0 +1,93 @@
+"""
+Extents of geo objects, `[min_lon, min_lat, max_lon, max_lat]` in EPSG:4326.
+
+Extents come from `meta.extent` (given on creation or returned by the tiler) or from
+coordinates of stored GeoJSON files. They are kept in the `min_lon`..`max_lat` columns of
+`object` and indexed by a GiST index over `box(point(min_lon, min_lat), point(max_lon, max_lat))`,
+an R-tree in core Postgres, so viewport queries do not need PostGIS.
+"""
+import math
+import os
+import typing
+
+import fastapi
+
+import serialization
+import settings
+
+
+Extent = tuple[float, float, float, float]
+EXTENT_COLUMNS = ('min_lon', 'min_lat', 'max_lon', 'max_lat')
+
+
+def parse_extent(value: typing.Any) -> Extent | None:
+    """Extent of 4 finite numbers with min <= max, otherwise `None`"""
+    if not isinstance(value, (list, tuple)) or len(value) != 4:
+        return None
+    if not all(isinstance(number, (int, float)) and not isinstance(number, bool) and math.isfinite(number) for number in value):
+        return None
+    min_lon, min_lat, max_lon, max_lat = (float(number) for number in value)
+    if min_lon > max_lon or min_lat > max_lat:
+        return None
+    return min_lon, min_lat, max_lon, max_lat
+
+
+def parse_bbox(bbox: str) -> Extent:
+    """`bbox=min_lon,min_lat,max_lon,max_lat` query parameter"""
+    try:
+        extent = parse_extent([float(number) for number in bbox.split(',')])
+    except ValueError:
+        extent = None
+    if extent is None:
+        raise fastapi.HTTPException(422, detail="bbox should be min_lon,min_lat,max_lon,max_lat")
+    return extent
+
+
+def extent_columns(extent: Extent | None) -> dict:
+    return dict(zip(EXTENT_COLUMNS, extent or (None,) * 4))
+
+
+def _positions(coordinates: typing.Any) -> typing.Iterator[list]:
+    if coordinates and isinstance(coordinates[0], (int, float)):
+        yield coordinates
+        return
+    for item in coordinates or []:
+        yield from _positions(item)
+
+
+def _geometries(geojson: dict) -> typing.Iterator[dict]:
+    if not isinstance(geojson, dict):
+        return
+    if geojson.get('type') == 'FeatureCollection':
+        for feature in geojson.get('features') or []:
+            yield from _geometries(feature)
+    elif geojson.get('type') == 'Feature':
+        yield from _geometries(geojson.get('geometry'))
+    elif geojson.get('type') == 'GeometryCollection':
+        for geometry in geojson.get('geometries') or []:
+            yield from _geometries(geometry)
+    else:
+        yield geojson
+
+
+def geojson_extent(path: str) -> Extent | None:
+    """Extent of a stored GeoJSON file, `bbox` member when present, else of all coordinates"""
+    try:
+        with open(os.path.join(settings.STORAGE_DIRECTORY, path), 'rb') as file:
+            geojson = serialization.loads(file.read())
+    except (OSError, ValueError):
+        return None
+    if isinstance(geojson, dict) and (extent := parse_extent(geojson.get('bbox'))):
+        return extent
+
+    min_lon = min_lat = math.inf
+    max_lon = max_lat = -math.inf
+    try:
+        for geometry in _geometries(geojson):
+            for position in _positions(geometry.get('coordinates')):
+                if len(position) >= 2:
+                    min_lon, max_lon = min(min_lon, position[0]), max(max_lon, position[0])
+                    min_lat, max_lat = min(min_lat, position[1]), max(max_lat, position[1])
+    except TypeError:
+        return None
+    return parse_extent([min_lon, min_lat, max_lon, max_lat])
@@ -0,0 +1,257 @@
+"""
+Versioned schema migrations.
+
+Applied versions are kept in `schema_migration`, startup applies only pending
+migrations in version order, each in its own transaction, and does nothing else
+when the schema is up to date. A session advisory lock makes API replicas that
+start together apply them once. Statements are idempotent (`IF NOT EXISTS`), so
+a database created by the former `create_all` startup adopts the baseline.
+
+A change of models in `main.py` needs a new migration appended to `MIGRATIONS`,
+applied migrations are never edited.
+
+    python migrations.py              # apply pending
+    python migrations.py --benchmark  # startup time in a scratch schema
+"""
+import argparse
+import asyncio
+import time
+import typing
+
+import sqlalchemy
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+
+import serialization
+import settings
+
+
+MIGRATIONS_LOCK_KEY = 0x6d696772  # "migr"
+
+
+class Migration(typing.NamedTuple):
+    version: int
+    name: str
+    statements: list[str]
+
+
+def _create_enum(name: str, values: list[str]) -> str:
+    labels = ', '.join(f"'{value}'" for value in values)
+    return f'DO $$ BEGIN CREATE TYPE {name} AS ENUM ({labels}); EXCEPTION WHEN duplicate_object THEN NULL; END $$'
+
+
+MIGRATIONS: list[Migration] = [
+    Migration(1, 'baseline', [
+        _create_enum('task_status_enum', ['created', 'started', 'running', 'completed', 'aborted']),
+        _create_enum('pathtypeenum', ['relative', 'absolute', 'url']),
+        '''CREATE TABLE IF NOT EXISTS source_code (
+            id SERIAL PRIMARY KEY,
+            entry_point VARCHAR NOT NULL,
+            hash VARCHAR(64)
+        )''',
+        '''CREATE TABLE IF NOT EXISTS task (
+            id SERIAL PRIMARY KEY,
+            status task_status_enum NOT NULL,
+            stacktrace VARCHAR,
+            source_code_id INTEGER REFERENCES source_code (id),
+            inputs JSON,
+            start_time TIMESTAMP WITH TIME ZONE NOT NULL,
+            progress FLOAT,
+            agent_id VARCHAR(64)
+        )''',
+        'CREATE INDEX IF NOT EXISTS ix_task_start_time_id ON task (start_time, id)',
+        'CREATE INDEX IF NOT EXISTS ix_task_agent_id ON task (agent_id)',
+        '''CREATE TABLE IF NOT EXISTS object (
+            id SERIAL PRIMARY KEY,
+            path VARCHAR NOT NULL,
+            path_type pathtypeenum NOT NULL,
+            algorithm_name VARCHAR,
+            type VARCHAR(64) NOT NULL,
+            meta JSON NOT NULL,
+            preview_path VARCHAR,
+            size BIGINT,
+            hash VARCHAR(64),
+            status VARCHAR(16) NOT NULL DEFAULT 'ready'
+        )''',
+        'CREATE INDEX IF NOT EXISTS ix_object_algorithm_name ON object (algorithm_name)',
+        'CREATE INDEX IF NOT EXISTS ix_object_type ON object (type)',
+        '''CREATE TABLE IF NOT EXISTS task_object (
+            task_id INTEGER NOT NULL REFERENCES task (id),
+            object_id INTEGER NOT NULL REFERENCES object (id),
+            PRIMARY KEY (task_id, object_id)
+        )''',
+        '''CREATE TABLE IF NOT EXISTS blob (
+            hash VARCHAR(64) PRIMARY KEY,
+            path VARCHAR NOT NULL,
+            size BIGINT NOT NULL,
+            ref_count INTEGER NOT NULL
+        )''',
+        '''CREATE TABLE IF NOT EXISTS "group" (
+            id SERIAL PRIMARY KEY,
+            task_id INTEGER REFERENCES task (id),
+            name VARCHAR,
+            meta JSON NOT NULL
+        )''',
+        '''CREATE TABLE IF NOT EXISTS agent (
+            id VARCHAR(64) PRIMARY KEY,
+            url VARCHAR NOT NULL,
+            capacity INTEGER NOT NULL,
+            running INTEGER NOT NULL,
+            queued INTEGER NOT NULL,
+            dispatched INTEGER NOT NULL,
+            last_heartbeat TIMESTAMP WITH TIME ZONE NOT NULL
+        )''',
+        '''CREATE TABLE IF NOT EXISTS event_outbox (
+            id BIGSERIAL PRIMARY KEY,
+            time TIMESTAMP WITH TIME ZONE NOT NULL,
+            type VARCHAR(32) NOT NULL,
+            instance JSON NOT NULL,
+            task_id INTEGER
+        )''',
+    ]),
+    Migration(2, 'detection_summary', [
+        '''CREATE TABLE IF NOT EXISTS detection_summary (
+            object_id INTEGER NOT NULL REFERENCES object (id),
+            category VARCHAR NOT NULL,
+            task_id INTEGER,
+            count INTEGER NOT NULL,
+            max_confidence FLOAT NOT NULL,
+            PRIMARY KEY (object_id, category)
+        )''',
+        'CREATE INDEX IF NOT EXISTS ix_detection_summary_category_max_confidence ON detection_summary (category, max_confidence)',
+        'CREATE INDEX IF NOT EXISTS ix_detection_summary_task_id ON detection_summary (task_id)',
+    ]),
+    Migration(3, 'object_extent', [
+        'ALTER TABLE object ADD COLUMN IF NOT EXISTS min_lon FLOAT',
+        'ALTER TABLE object ADD COLUMN IF NOT EXISTS min_lat FLOAT',
+        'ALTER TABLE object ADD COLUMN IF NOT EXISTS max_lon FLOAT',
+        'ALTER TABLE object ADD COLUMN IF NOT EXISTS max_lat FLOAT',
+        # Extents of existing objects from `meta.extent`
+        '''UPDATE object SET
+            min_lon = (meta->'extent'->>0)::float,
+            min_lat = (meta->'extent'->>1)::float,
+            max_lon = (meta->'extent'->>2)::float,
+            max_lat = (meta->'extent'->>3)::float
+        WHERE CASE WHEN json_typeof(meta->'extent') = 'array' THEN json_array_length(meta->'extent') END = 4
+            AND json_typeof(meta->'extent'->0) = 'number'
+            AND json_typeof(meta->'extent'->1) = 'number'
+            AND json_typeof(meta->'extent'->2) = 'number'
+            AND json_typeof(meta->'extent'->3) = 'number' ''',
+        '''CREATE INDEX IF NOT EXISTS ix_object_extent ON object
+            USING gist (box(point(min_lon, min_lat), point(max_lon, max_lat)))''',
+    ]),
+]
+
+
+def create_engine(**kwargs) -> AsyncEngine:
+    return create_async_engine(
+        settings.DATABASE_URL,
+        pool_size=settings.DB_POOL_SIZE,
+        max_overflow=settings.DB_MAX_OVERFLOW,
+        pool_timeout=settings.DB_POOL_TIMEOUT,
+        pool_recycle=settings.DB_POOL_RECYCLE,
+        pool_pre_ping=settings.DB_POOL_PRE_PING,
+        # JSON columns (`meta`, `inputs`, outbox events) with the fast encoder
+        json_serializer=lambda value: serialization.dumps(value).decode(),
+        json_deserializer=serialization.loads,
+        connect_args={
+            # asyncpg statement cache per connection, 0 behind pgbouncer in transaction mode
+            'statement_cache_size': settings.DB_STATEMENT_CACHE_SIZE,
+            # SQLAlchemy cache of prepared statements per connection
+            'prepared_statement_cache_size': settings.DB_PREPARED_STATEMENT_CACHE_SIZE,
+            **kwargs.pop('connect_args', { }),
+        },
+        **kwargs
+    )
+
+
+async def migrate(engine: AsyncEngine) -> list[int]:
+    """Apply pending migrations, returns applied versions"""
+    applied_now = []
+    async with engine.connect() as conn:
+        # Blocks until a concurrently starting replica is done, then nothing is pending
+        await conn.execute(sqlalchemy.select(sqlalchemy.func.pg_advisory_lock(MIGRATIONS_LOCK_KEY)))
+        await conn.commit()
+        try:
+            await conn.exec_driver_sql('''CREATE TABLE IF NOT EXISTS schema_migration (
+                version INTEGER PRIMARY KEY,
+                name VARCHAR NOT NULL,
+                applied_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+            )''')
+            applied = set((await conn.exec_driver_sql('SELECT version FROM schema_migration')).scalars())
+            await conn.commit()
+
+            for migration in MIGRATIONS:
+                if migration.version in applied:
+                    continue
+                for statement in migration.statements:
+                    await conn.exec_driver_sql(statement)
+                await conn.execute(
+                    sqlalchemy.text('INSERT INTO schema_migration (version, name) VALUES (:version, :name)'),
+                    { 'version': migration.version, 'name': migration.name }
+                )
+                await conn.commit()
+                applied_now.append(migration.version)
+        finally:
+            await conn.rollback()
+            await conn.execute(sqlalchemy.select(sqlalchemy.func.pg_advisory_unlock(MIGRATIONS_LOCK_KEY)))
+            await conn.commit()
+    return applied_now
+
+
+async def warm_up(engine: AsyncEngine, connections: int):
+    """Open pool connections ahead of the first requests"""
+    async def ping():
+        async with engine.connect() as conn:
+            await conn.exec_driver_sql('SELECT 1')
+    await asyncio.gather(*(ping() for _ in range(connections)))
+
+
+async def benchmark(runs: int):
+    """Cold (all migrations) and warm (up to date) startup in a scratch schema"""
+    schema = 'logsy_startup_benchmark'
+    admin = create_engine()
+    async with admin.begin() as conn:
+        await conn.exec_driver_sql(f'DROP SCHEMA IF EXISTS {schema} CASCADE')
+        await conn.exec_driver_sql(f'CREATE SCHEMA {schema}')
+
+    try:
+        timings = []
+        for run in range(runs + 1):
+            started = time.perf_counter()
+            engine = create_engine(connect_args={ 'server_settings': { 'search_path': schema } })
+            applied = await migrate(engine)
+            migrated = time.perf_counter()
+            await warm_up(engine, settings.DB_POOL_SIZE)
+            warmed = time.perf_counter()
+            await engine.dispose()
+            timings.append((len(applied), migrated - started, warmed - migrated))
+
+        applied, migrate_time, warm_up_time = timings[0]
+        print(f'cold: {applied} migrations {migrate_time * 1000:.1f} ms, pool warm-up {warm_up_time * 1000:.1f} ms')
+        warm = timings[1:]
+        if warm:
+            print(
+                f'warm: {sum(t[1] for t in warm) / len(warm) * 1000:.1f} ms migrations check, '
+                f'{sum(t[2] for t in warm) / len(warm) * 1000:.1f} ms pool warm-up (mean of {len(warm)})'
+            )
+    finally:
+        async with admin.begin() as conn:
+            await conn.exec_driver_sql(f'DROP SCHEMA IF EXISTS {schema} CASCADE')
+        await admin.dispose()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Apply logsy schema migrations')
+    parser.add_argument('--benchmark', action='store_true', help='Measure startup in a scratch schema instead')
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    if args.benchmark:
+        return await benchmark(args.runs)
+
+    engine = create_engine()
+    print('Applied migrations', await migrate(engine) or 'none, schema is up to date')
+    await engine.dispose()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,90 @@
+"""
+Keyset pagination for list endpoints.
+
+Pages are ordered by `(sort column, id)` and the cursor holds these values of the
+last returned row, so each page is an index range scan instead of an OFFSET.
+Next page cursor is returned in the `X-Next-Cursor` response header.
+"""
+import base64
+import datetime
+import enum
+import json
+
+import fastapi
+import sqlalchemy
+
+
+NEXT_CURSOR_HEADER = 'X-Next-Cursor'
+
+
+class SortOrder(enum.Enum):
+    asc = 'asc'
+    desc = 'desc'
+
+
+def encode_cursor(values: list) -> str:
+    return base64.urlsafe_b64encode(json.dumps(values, default=str).encode()).decode()
+
+
+def decode_cursor(cursor: str, sort_column) -> list:
+    try:
+        value, id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if isinstance(sort_column.type, sqlalchemy.DateTime) and value is not None:
+            value = datetime.datetime.fromisoformat(value)
+        return [value, int(id)]
+    except (ValueError, TypeError):
+        raise fastapi.HTTPException(422, detail="Invalid cursor")
+
+
+def parse_fields(model, fields: str | None) -> list[str] | None:
+    """Sparse field selection, `fields=id,status` -> ['id', 'status']"""
+    if not fields:
+        return None
+
+    names = list(dict.fromkeys(name.strip() for name in fields.split(',') if name.strip()))
+    unknown = [name for name in names if name not in model.__table__.columns]
+    if unknown:
+        raise fastapi.HTTPException(422, detail=f"Unknown fields: {', '.join(unknown)}")
+    return names
+
+
+async def paginate(
+    session,
+    stmt: sqlalchemy.Select,
+    model,
+    sort: str,
+    order: SortOrder,
+    cursor: str | None,
+    limit: int,
+    fields: list[str] | None,
+    response: fastapi.Response,
+) -> list:
+    sort_column = getattr(model, sort)
+    id_column = model.id
+
+    if cursor:
+        value, id = decode_cursor(cursor, sort_column)
+        if sort == 'id':
+            key, bound = id_column, id
+        else:
+            key, bound = sqlalchemy.tuple_(sort_column, id_column), sqlalchemy.tuple_(value, id)
+        stmt = stmt.where(key > bound if order == SortOrder.asc else key < bound)
+
+    if order == SortOrder.asc:
+        stmt = stmt.order_by(sort_column.asc(), id_column.asc())
+    else:
+        stmt = stmt.order_by(sort_column.desc(), id_column.desc())
+    stmt = stmt.limit(limit + 1)
+
+    # Plain column rows, no ORM instances. Cursor needs sort key and id even if they are not requested
+    names = fields or [column.name for column in model.__table__.columns]
+    columns = list(dict.fromkeys([*names, sort, 'id']))
+    stmt = stmt.with_only_columns(*(getattr(model, name) for name in columns))
+    rows = (await session.execute(stmt)).mappings().all()
+
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor([last[sort], last['id']])
+
+    return [{ name: row[name] for name in names } for row in rows]
@@ -0,0 +1,108 @@
+"""
+Image previews.
+
+Thumbnails are rendered with Pillow in a process pool, one WebP and one JPEG
+per size in `settings.PREVIEW_SIZES`. Files are keyed by content hash when it
+is known, so identical images share previews.
+"""
+import asyncio
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import typing
+
+import settings
+
+
+PREVIEWS_DIRECTORY = 'previews'
+PREVIEW_FORMATS = {
+    'webp': ('WEBP', { 'quality': 80, 'method': 4 }),
+    'jpeg': ('JPEG', { 'quality': 85, 'optimize': True }),
+}
+
+OnPreviewDone = typing.Callable[[int, str | None, str | None], typing.Awaitable[None]]
+
+
+def preview_prefix(object_id: int, hash: str | None) -> str:
+    if hash:
+        return f'{PREVIEWS_DIRECTORY}/{hash[:2]}/{hash}'
+    return f'{PREVIEWS_DIRECTORY}/objects/{object_id}'
+
+
+def preview_file(prefix: str, size: int, extension: str) -> str:
+    return f'{prefix}_{size}.{extension}'
+
+
+def choose_size(requested: int) -> int:
+    """Smallest preview not smaller than requested, largest one otherwise"""
+    sizes = sorted(settings.PREVIEW_SIZES)
+    return next((size for size in sizes if size >= requested), sizes[-1])
+
+
+def _render_previews(source_path: str, prefix: str) -> None:
+    """Runs in a worker process"""
+    from PIL import Image
+
+    files = [
+        (size, extension, os.path.join(settings.STORAGE_DIRECTORY, preview_file(prefix, size, extension)))
+        for size in settings.PREVIEW_SIZES
+        for extension in PREVIEW_FORMATS
+    ]
+    if all(os.path.exists(path) for _, _, path in files):
+        return
+
+    os.makedirs(os.path.dirname(files[0][2]), exist_ok=True)
+    with Image.open(os.path.join(settings.STORAGE_DIRECTORY, source_path)) as image:
+        largest = max(settings.PREVIEW_SIZES)
+        # Let JPEG decoder downscale while decoding, much cheaper than full decode
+        image.draft('RGB', (largest, largest))
+        image = image.convert('RGBA' if image.mode in ('RGBA', 'LA', 'P') else 'RGB')
+
+        # Downscale from the largest size, each step is cheaper than from original
+        for size in sorted(settings.PREVIEW_SIZES, reverse=True):
+            image.thumbnail((size, size), Image.Resampling.LANCZOS)
+            for extension, (format, options) in PREVIEW_FORMATS.items():
+                path = os.path.join(settings.STORAGE_DIRECTORY, preview_file(prefix, size, extension))
+                frame = image.convert('RGB') if format == 'JPEG' and image.mode != 'RGB' else image
+                frame.save(f'{path}.part', format, **options)
+                os.replace(f'{path}.part', path)
+
+
+class PreviewQueue:
+    def __init__(self) -> None:
+        self.executor: concurrent.futures.ProcessPoolExecutor = None
+        self.on_done: OnPreviewDone = None
+        self.pending: set[asyncio.Task] = set()
+
+    async def init(self, on_done: OnPreviewDone):
+        self.on_done = on_done
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=settings.PREVIEW_WORKERS,
+            mp_context=multiprocessing.get_context('spawn')
+        )
+
+    def submit(self, object_id: int, path: str, hash: str | None):
+        task = asyncio.create_task(self._render(object_id, path, preview_prefix(object_id, hash)))
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+
+    async def _render(self, object_id: int, path: str, prefix: str):
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self.executor, _render_previews, path, prefix)
+        except Exception as e:
+            logging.exception('Can not render previews for object %s', object_id)
+            await self.on_done(object_id, None, str(e))
+        else:
+            await self.on_done(object_id, prefix, None)
+
+    async def close(self):
+        for task in self.pending:
+            task.cancel()
+        await asyncio.gather(*self.pending, return_exceptions=True)
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+preview_queue = PreviewQueue()
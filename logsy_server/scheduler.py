@@ -0,0 +1,211 @@
+"""
+Dispatch of tasks with `source_code_id` to `logsy-agent`s.
+
+Agents send heartbeats with their capacity and load. Scheduler periodically, and
+right after heartbeats or new tasks, marks `created` tasks `started` on the least
+loaded alive agent, commits and then sends them (`POST {agent.url}/api/tasks/run`).
+Load is what the agent reported (running + queued) plus tasks dispatched to it
+since that heartbeat, agents at capacity get nothing and tasks wait here.
+
+Agents without heartbeat for `AGENT_TIMEOUT` are removed and their `started`/`running`
+tasks go back to `created`, so another agent runs them again.
+
+Only one scheduler at a time claims tasks (transaction-level advisory lock).
+"""
+import asyncio
+import datetime
+import logging
+import typing
+
+import aiohttp
+import sqlalchemy
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+import settings
+
+
+SCHEDULER_LOCK_KEY = 0x61676e74  # "agnt"
+
+ACTIVE_STATUSES = ('started', 'running')
+
+
+class TaskScheduler:
+    def __init__(self) -> None:
+        self.session_maker: async_sessionmaker = None
+        self.agent_model = None
+        self.task_model = None
+        self.source_code_model = None
+        self.on_updated: typing.Callable[[typing.Any, list], typing.Awaitable[None]] = None
+        self.http: aiohttp.ClientSession = None
+        self.wakeup = asyncio.Event()
+        self.worker: asyncio.Task = None
+        self.dispatched = 0
+        self.requeued = 0
+        self.dispatch_failures = 0
+
+    async def init(self, session_maker: async_sessionmaker, agent_model, task_model, source_code_model, on_updated):
+        """`on_updated(session, tasks)` is called in the transaction that changed `tasks`"""
+        self.session_maker = session_maker
+        self.agent_model = agent_model
+        self.task_model = task_model
+        self.source_code_model = source_code_model
+        self.on_updated = on_updated
+        self.http = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=settings.AGENT_DISPATCH_TIMEOUT))
+        self.worker = asyncio.create_task(self._schedule_forever())
+
+    def notify(self):
+        """Schedule now, e.g. after a heartbeat freed capacity or a task was created"""
+        self.wakeup.set()
+
+    def alive_after(self) -> datetime.datetime:
+        return datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=settings.AGENT_TIMEOUT)
+
+    async def _requeue_lost(self, session, cutoff: datetime.datetime):
+        Agent, Task = self.agent_model, self.task_model
+        alive = sqlalchemy.select(Agent.id).where(Agent.last_heartbeat >= cutoff)
+        tasks = (await session.scalars(
+            sqlalchemy.update(Task)
+            .where(Task.agent_id.is_not(None), Task.status.in_(ACTIVE_STATUSES), Task.agent_id.not_in(alive))
+            .values(agent_id=None, status='created')
+            .returning(Task)
+        )).all()
+        await session.execute(sqlalchemy.delete(Agent).where(Agent.last_heartbeat < cutoff))
+        if tasks:
+            logging.warning('Requeued %s tasks of lost agents', len(tasks))
+            self.requeued += len(tasks)
+            await self.on_updated(session, tasks)
+
+    async def _send(self, agent, task, source_code) -> bool:
+        try:
+            async with self.http.post(f'{agent.url.rstrip("/")}/api/tasks/run', json={
+                'task_id': task.id,
+                'entry_point': source_code.entry_point,
+                'source_hash': source_code.hash,
+            }) as response:
+                # 409 means the agent already has this task, e.g. sent again after a timed out response
+                if response.status < 300 or response.status == 409:
+                    return True
+                logging.warning('Agent %s refused task %s: %s', agent.id, task.id, await response.text())
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.warning('Can not dispatch task %s to agent %s: %s', task.id, agent.id, e)
+        self.dispatch_failures += 1
+        return False
+
+    async def _claim(self) -> list[tuple[typing.Any, typing.Any, typing.Any]]:
+        """Marks pending tasks `started` on the least loaded agents and commits, `(task, source_code, agent)`"""
+        Agent, Task, SourceCode = self.agent_model, self.task_model, self.source_code_model
+        async with self.session_maker.begin() as session:
+            locked = await session.scalar(sqlalchemy.select(sqlalchemy.func.pg_try_advisory_xact_lock(SCHEDULER_LOCK_KEY)))
+            if not locked:
+                return []
+
+            cutoff = self.alive_after()
+            await self._requeue_lost(session, cutoff)
+
+            agents = (await session.scalars(sqlalchemy.select(Agent).where(Agent.last_heartbeat >= cutoff))).all()
+            load = lambda agent: agent.running + agent.queued + agent.dispatched
+            free = sum(max(0, agent.capacity - load(agent)) for agent in agents)
+            if not free:
+                return []
+
+            pending = (await session.execute(
+                sqlalchemy.select(Task.id, SourceCode)
+                .join(SourceCode, Task.source_code_id == SourceCode.id)
+                .where(Task.status == 'created', Task.agent_id.is_(None))
+                .order_by(Task.start_time, Task.id)
+                .limit(free)
+            )).all()
+
+            claims = []
+            for task_id, source_code in pending:
+                candidates = [agent for agent in agents if load(agent) < agent.capacity]
+                if not candidates:
+                    break
+                # Least loaded relative to capacity
+                agent = min(candidates, key=lambda agent: load(agent) / agent.capacity)
+                task = (await session.scalars(
+                    sqlalchemy.update(Task)
+                    .where(Task.id == task_id, Task.status == 'created', Task.agent_id.is_(None))
+                    .values(agent_id=agent.id, status='started')
+                    .returning(Task)
+                )).one_or_none()
+                if task is None:
+                    continue
+                agent.dispatched += 1
+                claims.append((task, source_code, agent))
+
+            if claims:
+                await session.flush()
+                await self.on_updated(session, [task for task, _, _ in claims])
+            return claims
+
+    async def _requeue(self, agent, tasks: list):
+        """Tasks `agent` did not take go back to `created` unless something else changed them meanwhile"""
+        Agent, Task = self.agent_model, self.task_model
+        async with self.session_maker.begin() as session:
+            requeued = (await session.scalars(
+                sqlalchemy.update(Task)
+                .where(Task.id.in_([task.id for task in tasks]), Task.agent_id == agent.id, Task.status == 'started')
+                .values(agent_id=None, status='created')
+                .returning(Task)
+            )).all()
+            await session.execute(
+                sqlalchemy.update(Agent)
+                .where(Agent.id == agent.id)
+                .values(dispatched=sqlalchemy.func.greatest(Agent.dispatched - len(requeued), 0))
+            )
+            if requeued:
+                await self.on_updated(session, requeued)
+
+    async def _schedule(self) -> int:
+        """
+        Tasks are claimed and committed before agents are called, so an agent never runs a
+        task the database still has queued. Tasks of agents that can not be reached are put
+        back and go to another agent on a later pass.
+        """
+        claims = await self._claim()
+
+        failed: dict[str, tuple[typing.Any, list]] = { }
+        for task, source_code, agent in claims:
+            # After the first failure the agent gets nothing more this round
+            if agent.id in failed or not await self._send(agent, task, source_code):
+                failed.setdefault(agent.id, (agent, []))[1].append(task)
+
+        for agent, tasks in failed.values():
+            await self._requeue(agent, tasks)
+
+        dispatched = len(claims) - sum(len(tasks) for _, tasks in failed.values())
+        self.dispatched += dispatched
+        return dispatched
+
+    async def _schedule_forever(self):
+        while True:
+            self.wakeup.clear()
+            try:
+                await self._schedule()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logging.exception('Task scheduling failed')
+
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), settings.SCHEDULER_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    def metrics(self) -> dict:
+        return {
+            'dispatched': self.dispatched,
+            'requeued': self.requeued,
+            'dispatch_failures': self.dispatch_failures,
+        }
+
+    async def close(self):
+        if self.worker:
+            self.worker.cancel()
+            await asyncio.gather(self.worker, return_exceptions=True)
+        if self.http:
+            await self.http.close()
+
+
+scheduler = TaskScheduler()
@@ -0,0 +1,123 @@
+"""
+Fast JSON encoding of API responses.
+
+`dumps` uses orjson when it is installed (stdlib `json` otherwise), enums and
+datetimes are encoded natively. List and lookup endpoints select plain column
+rows and return `JSONResponse` themselves, so neither ORM instances are built
+and converted with `Base.to_dict` nor `jsonable_encoder` walks every value.
+
+Benchmark of encoding a 10k objects list: `python serialization.py --rows 10000`
+"""
+import argparse
+import datetime
+import enum
+import json
+import time
+import typing
+
+import fastapi
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _default(value):
+    if isinstance(value, enum.Enum):
+        return value.value
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+if orjson:
+    def dumps(value: typing.Any) -> bytes:
+        return orjson.dumps(value, default=_default, option=orjson.OPT_NON_STR_KEYS)
+
+    loads = orjson.loads
+else:
+    def dumps(value: typing.Any) -> bytes:
+        return json.dumps(value, default=_default, ensure_ascii=False, separators=(',', ':')).encode()
+
+    loads = json.loads
+
+
+class JSONResponse(fastapi.responses.Response):
+    """Content is encoded with `dumps`, `bytes` content is sent as already encoded JSON"""
+    media_type = 'application/json'
+
+    def render(self, content: typing.Any) -> bytes:
+        if isinstance(content, bytes):
+            return content
+        return dumps(content)
+
+
+def benchmark(rows: int, repeat: int):
+    import sqlalchemy
+    from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
+
+    class PathTypeEnum(enum.Enum):
+        absolute = 'absolute'
+
+    class Base(DeclarativeBase):
+        def to_dict(self):
+            return { c.name: getattr(self, c.name) for c in self.__table__.columns }
+
+    # Same columns as `main.Object`, defined here to not import the app
+    class Object(Base):
+        __tablename__ = 'object'
+        id: Mapped[int] = mapped_column(primary_key=True)
+        path: Mapped[str] = mapped_column()
+        path_type: Mapped[str] = mapped_column(sqlalchemy.Enum(PathTypeEnum))
+        algorithm_name: Mapped[str] = mapped_column(nullable=True)
+        type: Mapped[str] = mapped_column(sqlalchemy.String(64))
+        meta: Mapped[str] = mapped_column(sqlalchemy.JSON())
+        preview_path: Mapped[str] = mapped_column(nullable=True)
+        size: Mapped[int] = mapped_column(sqlalchemy.BigInteger(), nullable=True)
+        hash: Mapped[str] = mapped_column(sqlalchemy.String(64), nullable=True)
+        status: Mapped[str] = mapped_column(sqlalchemy.String(16))
+
+    columns = [column.name for column in Object.__table__.columns]
+    values = [
+        (
+            id, f'blobs/{id:064x}.json', PathTypeEnum.absolute, 'detector', 'json',
+            { 'created': datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc).isoformat(), 'count': id % 50 },
+            None, 1024 + id, f'{id:064x}', 'ready'
+        )
+        for id in range(rows)
+    ]
+
+    def orm_response() -> bytes:
+        # Former path: ORM instances, `jsonable_encoder`, starlette `JSONResponse`
+        instances = [Object(**dict(zip(columns, row))) for row in values]
+        content = fastapi.encoders.jsonable_encoder([instance.to_dict() for instance in instances])
+        return fastapi.responses.JSONResponse(content).body
+
+    def rows_response() -> bytes:
+        return JSONResponse([dict(zip(columns, row)) for row in values]).body
+
+    def stdlib_rows_response() -> bytes:
+        content = [dict(zip(columns, row)) for row in values]
+        return json.dumps(content, default=_default, ensure_ascii=False, separators=(',', ':')).encode()
+
+    paths = [('ORM + jsonable_encoder', orm_response), ('rows + stdlib json', stdlib_rows_response)]
+    if orjson:
+        paths.append(('rows + orjson', rows_response))
+    else:
+        print('orjson is not installed, `dumps` uses stdlib json')
+
+    for name, render in paths:
+        started = time.perf_counter()
+        for _ in range(repeat):
+            body = render()
+        elapsed = (time.perf_counter() - started) / repeat
+        print(f'{name:24}: {elapsed * 1000:8.1f} ms per {rows} objects response, {len(body) / 1024:.0f} KiB')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Time to encode an objects list response')
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+    benchmark(args.rows, args.repeat)
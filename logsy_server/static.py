@@ -0,0 +1,198 @@
+"""
+Storage file serving with validators, range requests and precompressed variants.
+
+- Strong `ETag`: content hash for content-addressed blobs, inode/mtime/size otherwise
+- `Cache-Control: immutable` for paths that never change (blobs, previews, XYZ tiles),
+  revalidation with `If-None-Match` -> `304` for everything else
+- Single `Range` requests -> `206`, used by raster viewers and resumed downloads
+- JSON is served from `.br`/`.gz` siblings created on first request
+"""
+import asyncio
+import contextlib
+import gzip
+import mimetypes
+import os
+import re
+import typing
+import uuid
+
+import fastapi
+
+import settings
+import storage
+import previews
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+mimetypes.add_type('image/webp', '.webp')
+mimetypes.add_type('application/geo+json', '.geojson')
+
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+REVALIDATE_CACHE_CONTROL = 'no-cache'
+
+IMMUTABLE_PREFIXES = (f'{storage.BLOBS_DIRECTORY}/', f'{previews.PREVIEWS_DIRECTORY}/')
+TILE_PATTERN = re.compile(r'/\d+/\d+/-?\d+\.(webp|png|jpe?g)$')
+BLOB_PATTERN = re.compile(rf'^{storage.BLOBS_DIRECTORY}/[0-9a-f]{{2}}/([0-9a-f]{{64}})')
+RANGE_PATTERN = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+COMPRESSIBLE_EXTENSIONS = ('.json', '.geojson')
+# (Content-Encoding, file suffix), in preference order
+ENCODINGS = ([('br', '.br')] if brotli else []) + [('gzip', '.gz')]
+
+
+def resolve(path: str) -> str:
+    root = os.path.realpath(settings.STORAGE_DIRECTORY)
+    full_path = os.path.realpath(os.path.join(root, path))
+    if os.path.commonpath([root, full_path]) != root:
+        raise fastapi.HTTPException(404)
+    return full_path
+
+
+def is_immutable(path: str) -> bool:
+    return path.startswith(IMMUTABLE_PREFIXES) or bool(TILE_PATTERN.search(path))
+
+
+def make_etag(path: str, stat: os.stat_result, encoding: str = None) -> str:
+    if match := BLOB_PATTERN.match(path):
+        tag = match.group(1)
+    else:
+        tag = f'{stat.st_ino:x}-{stat.st_mtime_ns:x}-{stat.st_size:x}'
+    return f'"{tag}-{encoding}"' if encoding else f'"{tag}"'
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    candidates = [candidate.strip().removeprefix('W/') for candidate in header.split(',')]
+    return '*' in candidates or etag in candidates
+
+
+def _compress(full_path: str, encoding: str, suffix: str) -> None:
+    """
+    Streams the file through the compressor into a temp file of this request, concurrent first
+    requests of the same file each write their own and the last rename wins.
+    """
+    partial_path = f'{full_path}{suffix}.{uuid.uuid4().hex}.part'
+    try:
+        with open(full_path, 'rb') as source, open(partial_path, 'wb') as target:
+            if encoding == 'br':
+                compressor = brotli.Compressor(quality=9)
+                while chunk := source.read(settings.STATIC_CHUNK_SIZE):
+                    target.write(compressor.process(chunk))
+                target.write(compressor.finish())
+            else:
+                with gzip.GzipFile(fileobj=target, mode='wb', compresslevel=9) as compressed:
+                    while chunk := source.read(settings.STATIC_CHUNK_SIZE):
+                        compressed.write(chunk)
+        try:
+            os.replace(partial_path, f'{full_path}{suffix}')
+        except FileNotFoundError:
+            # Temp file gone, another request already put its variant in place
+            pass
+    finally:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(partial_path)
+
+
+def _precompressed(full_path: str, stat: os.stat_result, accept_encoding: str) -> tuple[str, str, os.stat_result] | None:
+    """Best accepted compressed sibling, created or refreshed if missing or older than the file"""
+    accepted = { value.split(';')[0].strip() for value in accept_encoding.split(',') }
+    for encoding, suffix in ENCODINGS:
+        if encoding not in accepted:
+            continue
+        try:
+            variant_stat = os.stat(f'{full_path}{suffix}')
+            if variant_stat.st_mtime_ns < stat.st_mtime_ns:
+                raise FileNotFoundError
+        except FileNotFoundError:
+            _compress(full_path, encoding, suffix)
+            variant_stat = os.stat(f'{full_path}{suffix}')
+        return encoding, f'{full_path}{suffix}', variant_stat
+    return None
+
+
+async def _file_chunks(full_path: str, start: int, length: int) -> typing.AsyncIterator[bytes]:
+    with open(full_path, 'rb') as file:
+        file.seek(start)
+        while length > 0:
+            chunk = await asyncio.to_thread(file.read, min(settings.STATIC_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def _parse_range(header: str, size: int) -> tuple[int, int] | None:
+    """`(start, end)` inclusive for a single satisfiable range, `None` to serve whole file"""
+    match = RANGE_PATTERN.match(header.strip())
+    if not match or match.groups() == ('', ''):
+        # Multiple ranges or unknown unit, full response is allowed
+        return None
+
+    first, last = match.groups()
+    if first == '':
+        start, end = max(0, size - int(last)), size - 1
+    else:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise fastapi.HTTPException(416, headers={ 'Content-Range': f'bytes */{size}' })
+    return start, end
+
+
+async def serve_file(request: fastapi.Request, path: str, cache_control: str = None) -> fastapi.Response:
+    full_path = resolve(path)
+    try:
+        stat = await asyncio.to_thread(os.stat, full_path)
+    except (FileNotFoundError, NotADirectoryError):
+        raise fastapi.HTTPException(404)
+    if not os.path.isfile(full_path):
+        raise fastapi.HTTPException(404)
+
+    media_type = mimetypes.guess_type(full_path)[0] or 'application/octet-stream'
+    headers = {
+        'Cache-Control': cache_control or (IMMUTABLE_CACHE_CONTROL if is_immutable(path) else REVALIDATE_CACHE_CONTROL),
+        'Accept-Ranges': 'bytes',
+    }
+
+    serve_path, serve_stat, encoding = full_path, stat, None
+    range_header = request.headers.get('range')
+    if full_path.endswith(COMPRESSIBLE_EXTENSIONS):
+        headers['Vary'] = 'Accept-Encoding'
+        if not range_header and stat.st_size >= settings.STATIC_COMPRESS_MIN_SIZE:
+            variant = await asyncio.to_thread(_precompressed, full_path, stat, request.headers.get('accept-encoding', ''))
+            if variant:
+                encoding, serve_path, serve_stat = variant
+                headers['Content-Encoding'] = encoding
+
+    etag = make_etag(path, stat, encoding)
+    headers['ETag'] = etag
+
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match and _etag_matches(if_none_match, etag):
+        return fastapi.Response(status_code=304, headers=headers)
+
+    start, end = 0, serve_stat.st_size - 1
+    status_code = 200
+    if range_header and encoding is None:
+        if_range = request.headers.get('if-range')
+        if not if_range or if_range == etag:
+            byte_range = _parse_range(range_header, serve_stat.st_size)
+            if byte_range:
+                start, end = byte_range
+                status_code = 206
+                headers['Content-Range'] = f'bytes {start}-{end}/{serve_stat.st_size}'
+
+    length = max(0, end - start + 1)
+    headers['Content-Length'] = str(length)
+    if request.method == 'HEAD':
+        return fastapi.Response(status_code=status_code, headers=headers, media_type=media_type)
+
+    return fastapi.responses.StreamingResponse(
+        _file_chunks(serve_path, start, length),
+        status_code=status_code,
+        headers=headers,
+        media_type=media_type
+    )
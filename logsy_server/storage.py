@@ -0,0 +1,108 @@
+"""
+Content-addressed storage.
+
+Uploaded bytes are stored once per sha256 under `blobs/{hash[:2]}/{hash}{extension}`
+inside `settings.STORAGE_DIRECTORY`. Reference counting lives in the `blob` table,
+so identical uploads from many tasks only add object rows.
+"""
+import asyncio
+import hashlib
+import os
+import typing
+import uuid
+
+import fastapi
+
+import settings
+
+
+BLOBS_DIRECTORY = 'blobs'
+
+
+class StoredFile(typing.NamedTuple):
+    path: str
+    size: int
+    hash: str
+
+
+def blob_path(hash: str, file_extension: str) -> str:
+    return f'{BLOBS_DIRECTORY}/{hash[:2]}/{hash}{file_extension}'
+
+
+def _store_partial(partial_path: str, hash: str, file_extension: str) -> str:
+    path = blob_path(hash, file_extension)
+    full_path = os.path.join(settings.STORAGE_DIRECTORY, path)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    # Same hash means same bytes, replacing an existing blob is harmless
+    os.replace(partial_path, full_path)
+    return path
+
+
+def _partial_path() -> str:
+    directory = os.path.join(settings.STORAGE_DIRECTORY, BLOBS_DIRECTORY)
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, f'{uuid.uuid4()}.part')
+
+
+def _write_stream(sources: typing.Iterable[typing.BinaryIO], file_extension: str) -> StoredFile:
+    """Copy `sources` one after another to storage in bounded chunks, hashing on the fly"""
+    digest = hashlib.sha256()
+    size = 0
+    partial_path = _partial_path()
+
+    try:
+        with open(partial_path, 'wb') as outfile:
+            for source in sources:
+                while chunk := source.read(settings.UPLOAD_CHUNK_SIZE):
+                    digest.update(chunk)
+                    outfile.write(chunk)
+                    size += len(chunk)
+        hash = digest.hexdigest()
+        return StoredFile(_store_partial(partial_path, hash, file_extension), size, hash)
+    except BaseException:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+
+
+async def save_upload(file: fastapi.UploadFile) -> StoredFile:
+    """
+    Stream upload to storage. Blocking file IO and hashing run in a worker
+    thread, so the event loop keeps serving other requests meanwhile.
+    """
+    _, file_extension = os.path.splitext(file.filename or '')
+    await file.seek(0)
+    return await asyncio.to_thread(_write_stream, [file.file], file_extension)
+
+
+def _open_files(paths: list[str]) -> typing.Iterator[typing.BinaryIO]:
+    for path in paths:
+        with open(path, 'rb') as file:
+            yield file
+
+
+async def save_files(paths: list[str], file_extension: str) -> StoredFile:
+    """Concatenate local files (e.g. upload chunks) into one storage file"""
+    return await asyncio.to_thread(_write_stream, _open_files(paths), file_extension)
+
+
+def _write_content(content: bytes, file_extension: str) -> StoredFile:
+    hash = hashlib.sha256(content).hexdigest()
+    partial_path = _partial_path()
+    with open(partial_path, 'wb') as outfile:
+        outfile.write(content)
+    return StoredFile(_store_partial(partial_path, hash, file_extension), len(content), hash)
+
+
+async def save_content(content: bytes, file_extension: str) -> StoredFile:
+    return await asyncio.to_thread(_write_content, content, file_extension)
+
+
+async def remove_duplicate(stored: StoredFile, canonical_path: str) -> None:
+    """
+    Drop a freshly written file when the blob was already stored under another
+    extension. Files at the canonical path are shared and never removed here.
+    """
+    if stored.path != canonical_path:
+        full_path = os.path.join(settings.STORAGE_DIRECTORY, stored.path)
+        await asyncio.to_thread(lambda: os.path.exists(full_path) and os.remove(full_path))
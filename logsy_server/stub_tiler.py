@@ -0,0 +1,63 @@
+"""
+Local stand-in for the tiler service, for development and tests without GDAL.
+
+    python stub_tiler.py  # then run server with TILER_ADDRESS=localhost:50051
+
+Answers `CreateTiles` after `STUB_TILER_DELAY` seconds with fixed metadata,
+paths containing `error` are answered with an error.
+"""
+import asyncio
+import json
+import logging
+import os
+
+import grpc
+
+import tiler_pb2_grpc
+import tiler_pb2
+import settings
+
+
+logging.getLogger().setLevel(logging.INFO)
+
+STUB_TILER_DELAY = float(os.getenv('STUB_TILER_DELAY', 1))
+
+
+class StubTilerService(tiler_pb2_grpc.TilerServiceServicer):
+    async def CreateTiles(self, request: tiler_pb2.CreateTilesRequest, context) -> tiler_pb2.CreateTilesResponse:
+        logging.info('CreateTiles %s', request.path)
+        await asyncio.sleep(STUB_TILER_DELAY)
+
+        if 'error' in request.path:
+            return tiler_pb2.CreateTilesResponse(error=f'Can not open {request.path}')
+
+        tiles_path = f'{os.path.splitext(request.path)[0]}_tiles'
+        return tiler_pb2.CreateTilesResponse(
+            path=tiles_path,
+            tilemapresource_path=f'{tiles_path}/tilemapresource.xml',
+            meta=json.dumps({
+                'extension': 'webp',
+                'tile_size': [256, 256],
+                'min_zoom': 15,
+                'max_zoom': 21,
+                'extent': [49.10, 55.78, 49.13, 55.80],
+            })
+        )
+
+
+async def serve(address: str = settings.TILER_ADDRESS) -> grpc.aio.Server:
+    server = grpc.aio.server()
+    tiler_pb2_grpc.add_TilerServiceServicer_to_server(StubTilerService(), server)
+    server.add_insecure_port(address)
+    await server.start()
+    return server
+
+
+async def main():
+    server = await serve()
+    logging.info('Stub tiler is listening on %s', settings.TILER_ADDRESS)
+    await server.wait_for_termination()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,94 @@
+"""
+GeoTIFF tiling jobs.
+
+Tiler calls reuse a small pool of long-lived gRPC channels and run in a fixed
+number of background workers, so HTTP handlers only enqueue a job and return.
+"""
+import asyncio
+import itertools
+import logging
+import typing
+
+import grpc
+
+import tiler_pb2_grpc
+import tiler_pb2
+import settings
+
+
+OnTilingDone = typing.Callable[[int, tiler_pb2.CreateTilesResponse | None, str | None], typing.Awaitable[None]]
+
+
+class TilerChannelPool:
+    def __init__(self, address: str, size: int) -> None:
+        self.address = address
+        self.size = size
+        self.channels: list[grpc.aio.Channel] = []
+        self._stubs = None
+
+    def init(self):
+        self.channels = [grpc.aio.insecure_channel(self.address) for _ in range(self.size)]
+        self._stubs = itertools.cycle([tiler_pb2_grpc.TilerServiceStub(channel) for channel in self.channels])
+
+    def stub(self) -> tiler_pb2_grpc.TilerServiceStub:
+        return next(self._stubs)
+
+    async def close(self):
+        for channel in self.channels:
+            await channel.close()
+        self.channels = []
+
+
+class TilingQueue:
+    def __init__(self) -> None:
+        self.pool = TilerChannelPool(settings.TILER_ADDRESS, settings.TILER_CHANNELS)
+        self.queue: asyncio.Queue[tuple[int, str]] = asyncio.Queue()
+        self.workers: list[asyncio.Task] = []
+        self.on_done: OnTilingDone = None
+
+    async def init(self, on_done: OnTilingDone):
+        self.on_done = on_done
+        self.pool.init()
+        self.workers = [asyncio.create_task(self._work()) for _ in range(settings.TILING_CONCURRENCY)]
+
+    def submit(self, object_id: int, path: str):
+        self.queue.put_nowait((object_id, path))
+
+    @property
+    def depth(self) -> int:
+        return self.queue.qsize()
+
+    async def _work(self):
+        while True:
+            object_id, path = await self.queue.get()
+            try:
+                await self._tile(object_id, path)
+            except Exception:
+                logging.exception('Tiling failed for object %s', object_id)
+            finally:
+                self.queue.task_done()
+
+    async def _tile(self, object_id: int, path: str):
+        try:
+            response: tiler_pb2.CreateTilesResponse = await self.pool.stub().CreateTiles(
+                tiler_pb2.CreateTilesRequest(path=path),
+                timeout=settings.TILING_TIMEOUT
+            )
+        except grpc.aio.AioRpcError as e:
+            await self.on_done(object_id, None, f'{e.code().name}: {e.details()}')
+            return
+
+        if response.error:
+            await self.on_done(object_id, None, response.error)
+        else:
+            await self.on_done(object_id, response, None)
+
+    async def close(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        await self.pool.close()
+
+
+tiling_queue = TilingQueue()
@@ -0,0 +1,118 @@
+"""
+Resumable chunked uploads.
+
+Session state lives on disk under `settings.UPLOADS_DIRECTORY/{upload_id}`:
+`session.json` with declared size and chunk size, plus one file per received
+chunk named by its index. Sessions survive server restarts, so a client can
+query received ranges and re-send only missing chunks.
+"""
+import asyncio
+import json
+import os
+import shutil
+import uuid
+
+import settings
+import storage
+
+
+class UploadError(Exception):
+    pass
+
+
+def _session_directory(upload_id: str) -> str:
+    # Upload id is used as a directory name, never trust it as a path
+    return os.path.join(settings.UPLOADS_DIRECTORY, str(uuid.UUID(upload_id)))
+
+
+def chunks_count(session: dict) -> int:
+    return max(1, -(-session['size'] // session['chunk_size']))
+
+
+def chunk_length(session: dict, index: int) -> int:
+    start = index * session['chunk_size']
+    return min(session['chunk_size'], session['size'] - start)
+
+
+def _create_session(filename: str, size: int, chunk_size: int) -> dict:
+    session = {
+        'id': str(uuid.uuid4()),
+        'filename': filename,
+        'size': size,
+        'chunk_size': chunk_size,
+    }
+    directory = _session_directory(session['id'])
+    os.makedirs(directory)
+    with open(os.path.join(directory, 'session.json'), 'w') as file:
+        json.dump(session, file)
+    return session
+
+
+async def create_session(filename: str, size: int, chunk_size: int = None) -> dict:
+    return await asyncio.to_thread(_create_session, filename, size, chunk_size or settings.UPLOAD_SESSION_CHUNK_SIZE)
+
+
+def _load_session(upload_id: str) -> dict:
+    try:
+        with open(os.path.join(_session_directory(upload_id), 'session.json')) as file:
+            return json.load(file)
+    except (ValueError, FileNotFoundError):
+        raise UploadError(f'Upload {upload_id} not found')
+
+
+async def load_session(upload_id: str) -> dict:
+    return await asyncio.to_thread(_load_session, upload_id)
+
+
+def _write_chunk(session: dict, index: int, content: bytes) -> None:
+    chunk_path = os.path.join(_session_directory(session['id']), str(index))
+    with open(f'{chunk_path}.part', 'wb') as file:
+        file.write(content)
+    os.replace(f'{chunk_path}.part', chunk_path)
+
+
+async def write_chunk(session: dict, index: int, content: bytes) -> None:
+    if not 0 <= index < chunks_count(session):
+        raise UploadError(f'Chunk index {index} is out of range')
+    if len(content) != chunk_length(session, index):
+        raise UploadError(f'Chunk {index} should be {chunk_length(session, index)} bytes, got {len(content)}')
+    await asyncio.to_thread(_write_chunk, session, index, content)
+
+
+def _received_chunks(session: dict) -> list[int]:
+    names = os.listdir(_session_directory(session['id']))
+    return sorted(int(name) for name in names if name.isdigit())
+
+
+def _received_ranges(session: dict) -> list[list[int]]:
+    """Merged `[start, end)` byte ranges of received chunks"""
+    ranges = []
+    for index in _received_chunks(session):
+        start = index * session['chunk_size']
+        end = start + chunk_length(session, index)
+        if ranges and ranges[-1][1] == start:
+            ranges[-1][1] = end
+        else:
+            ranges.append([start, end])
+    return ranges
+
+
+async def received_ranges(session: dict) -> list[list[int]]:
+    return await asyncio.to_thread(_received_ranges, session)
+
+
+async def complete(session: dict) -> storage.StoredFile:
+    """Assemble received chunks into a storage file and drop the session"""
+    received = await asyncio.to_thread(_received_chunks, session)
+    if len(received) != chunks_count(session):
+        raise UploadError(f'Upload is incomplete, received {len(received)} of {chunks_count(session)} chunks')
+
+    directory = _session_directory(session['id'])
+    _, file_extension = os.path.splitext(session['filename'] or '')
+    stored = await storage.save_files([os.path.join(directory, str(i)) for i in received], file_extension)
+    await remove_session(session)
+    return stored
+
+
+async def remove_session(session: dict) -> None:
+    await asyncio.to_thread(shutil.rmtree, _session_directory(session['id']), True)
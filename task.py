@@ -1,5 +1,6 @@
 import asyncio
 import requests
+import logsy
 from logsy import Task
 
 async def main(task: Task):
@@ -101,12 +102,13 @@ async def main(task: Task):
 
 if __name__ == '__main__':
     async def async_launch():
-        await main(await Task.init({
-            'ortomosaic': 'kazan.tif',
-            'geojsons': [
-                'kazan-body.geojson',
-                'kazan-cadastr.geojson'
-            ],
-        }))
+        async with logsy.client:
+            await main(await Task.init({
+                'ortomosaic': 'kazan.tif',
+                'geojsons': [
+                    'kazan-body.geojson',
+                    'kazan-cadastr.geojson'
+                ],
+            }))
 
     asyncio.run(async_launch())